@@ -1,3 +1,4 @@
 from .dropbox_auth import *
+from .dropbox_cache import *
 from .dropbox_client import *
 from .dropbox_util import *
@@ -0,0 +1,101 @@
+import os
+import sublime
+import threading
+
+
+DELTA_CACHE_VERSION = 1
+DELTA_CACHE_FILENAME = "dropbox.drsync-delta"
+
+
+class DropboxDeltaCache():
+	def __init__(self, cursor=None, entries=None):
+		self.lock = threading.Lock()
+		self.cursor = cursor
+		self.entries = {}
+		if entries:
+			self.entries.update(entries)
+
+	@staticmethod
+	def local_path():
+		return os.path.join(sublime.packages_path(), "User", "DrSync", DELTA_CACHE_FILENAME)
+
+	@staticmethod
+	def build_key(path):
+		return "/" + path.replace("\\", "/").strip("/").lower()
+
+	def reset(self):
+		with self.lock:
+			self.cursor = None
+			self.entries = {}
+
+	def set(self, key, metadata):
+		with self.lock:
+			self.entries[key] = {
+				"path": metadata["path"],
+				"is_dir": metadata.get("is_dir", False),
+				"bytes": metadata.get("bytes", 0),
+				"rev": metadata.get("rev")
+			}
+
+	def remove(self, key):
+		with self.lock:
+			prefix = key + "/"
+			for entry in list(self.entries.keys()):
+				if entry == key or entry.startswith(prefix):
+					del self.entries[entry]
+
+	def update(self, client):
+		while True:
+			result = client.delta(self.cursor)
+			if result.get("reset"):
+				with self.lock:
+					self.entries = {}
+			for path, metadata in result["entries"]:
+				key = self.build_key(path)
+				if metadata is None:
+					self.remove(key)
+				else:
+					self.set(key, metadata)
+			self.cursor = result["cursor"]
+			if not result.get("has_more"):
+				return
+
+	def get(self, path):
+		with self.lock:
+			entry = self.entries.get(self.build_key(path))
+			if entry is None or entry["is_dir"]:
+				return None
+			return dict(entry)
+
+	def files_under(self, dir_path):
+		prefix = self.build_key(dir_path) + "/"
+		with self.lock:
+			return sorted([[entry["path"], entry["bytes"], entry["rev"]] for key, entry in self.entries.items() if key.startswith(prefix) and not entry["is_dir"]])
+
+	@staticmethod
+	def load(filepath=None):
+		filepath = filepath or DropboxDeltaCache.local_path()
+		if not os.path.exists(filepath):
+			return DropboxDeltaCache()
+		try:
+			f = open(filepath, "r")
+			try:
+				data = sublime.decode_value(f.read())
+			finally:
+				f.close()
+		except Exception:
+			return DropboxDeltaCache()
+		if not isinstance(data, dict) or data.get("version") != DELTA_CACHE_VERSION:
+			return DropboxDeltaCache()
+		return DropboxDeltaCache(data.get("cursor"), data.get("entries"))
+
+	def save(self, filepath=None):
+		filepath = filepath or DropboxDeltaCache.local_path()
+		parent = os.path.dirname(filepath)
+		if not os.path.exists(parent):
+			os.makedirs(parent)
+		with self.lock:
+			data = sublime.encode_value({"version": DELTA_CACHE_VERSION, "cursor": self.cursor, "entries": self.entries})
+		out = open(filepath, "w")
+		out.write(data)
+		out.close()
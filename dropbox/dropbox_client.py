@@ -1,13 +1,22 @@
 import re
+import os
+import threading
 from .dropbox_connection import *
 from .dropbox_session import *
 from .dropbox_util import *
 
 OAUTH2_ACCESS_TOKEN_PATTERN = re.compile(r"\A[-_~/A-Za-z0-9\.\+]+=*\Z")
+CHUNKED_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+CHUNKED_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNKED_UPLOAD_MAX_RESUMES = 5
 
 class DropboxClient():
 	def __init__(self, access_token):
 		self.connection = DropboxConnection()
+		self.upload_sessions = {}
+		self.upload_lock = threading.Lock()
+		self.chunked_threshold = CHUNKED_UPLOAD_THRESHOLD
+		self.chunk_size = CHUNKED_UPLOAD_CHUNK_SIZE
 		if type(access_token) == str:
 			if not OAUTH2_ACCESS_TOKEN_PATTERN.match(access_token):
 				raise ValueError("invalid format for oauth2_access_token: %r" % (access_token))
@@ -31,12 +40,90 @@ class DropboxClient():
 		url, params, headers = self.request("/account/info", method="GET")
 		return self.connection.get(url, headers)
 
+	def configure_retries(self, settings=None, on_retry=None):
+		self.connection.retry_policy = RetryPolicy.from_settings(settings)
+		self.connection.retry_policy.on_retry = on_retry
+		return self.connection.retry_policy
+
+	def configure_uploads(self, settings=None):
+		settings = settings or {}
+		self.chunked_threshold = settings.get("resumable_threshold", CHUNKED_UPLOAD_THRESHOLD)
+		self.chunk_size = max(1, settings.get("chunk_size", CHUNKED_UPLOAD_CHUNK_SIZE))
+
 	def put_file(self, full_path, file_obj):
+		size = os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+		if self.chunked_threshold is not None and size > 0 and size >= self.chunked_threshold:
+			return self.put_file_chunked(full_path, file_obj, size)
 		path = "/files_put/%s%s" % (self.session.root, DropboxUtil.format_path(full_path))
 		params = {"overwrite": True}
 		url, params, headers = self.request(path, params, method="PUT", content_server=True)
 		return self.connection.put(url, file_obj, headers)
 
+	def get_upload_session(self, key):
+		with self.upload_lock:
+			return self.upload_sessions.get(key, (None, 0))
+
+	def set_upload_session(self, key, upload_id, offset):
+		with self.upload_lock:
+			if upload_id is None:
+				self.upload_sessions.pop(key, None)
+			else:
+				self.upload_sessions[key] = (upload_id, offset)
+
+	def put_file_chunked(self, full_path, file_obj, size):
+		base = file_obj.tell()
+		stat = os.fstat(file_obj.fileno())
+		key = "%s:%d:%d" % (DropboxUtil.format_path(full_path), size, stat.st_mtime)
+		upload_id, offset = self.get_upload_session(key)
+		resumes = 0
+		while offset < size:
+			file_obj.seek(base + offset)
+			chunk = file_obj.read(self.chunk_size)
+			params = {"offset": offset}
+			if upload_id is not None:
+				params["upload_id"] = upload_id
+			url, params, headers = self.request("/chunked_upload", params, method="PUT", content_server=True)
+			try:
+				response = self.connection.put(url, chunk, headers)
+			except Exception as e:
+				resumes += 1
+				if resumes > CHUNKED_UPLOAD_MAX_RESUMES:
+					raise e
+				if isinstance(e, ErrorResponse):
+					if e.status == 400 and isinstance(e.body, dict) and "offset" in e.body:
+						upload_id = e.body.get("upload_id", upload_id)
+						offset = e.body["offset"]
+						continue
+					if e.status == 404:
+						upload_id = None
+						offset = 0
+						self.set_upload_session(key, None, 0)
+						continue
+					if e.status < 500 or RetryPolicy.is_exhausted(e):
+						raise e
+				if upload_id is None:
+					raise e
+				continue
+			upload_id = response["upload_id"]
+			offset = response["offset"]
+			self.set_upload_session(key, upload_id, offset)
+		path = "/commit_chunked_upload/%s%s" % (self.session.root, DropboxUtil.format_path(full_path))
+		params = {"upload_id": upload_id, "overwrite": True}
+		url, params, headers = self.request(path, params, method="POST", content_server=True)
+		file_data = self.connection.post(url, params, headers)
+		self.set_upload_session(key, None, 0)
+		return file_data
+
+	def delete_file(self, full_path):
+		params = {"root": self.session.root, "path": DropboxUtil.format_path(full_path)}
+		url, params, headers = self.request("/fileops/delete", params, method="POST")
+		try:
+			return self.connection.post(url, params, headers)
+		except ErrorResponse as e:
+			if e.status == 404:
+				return None
+			raise e
+
 	def get_file(self, full_path):
 		path = "/files/%s%s" % (self.session.root, DropboxUtil.format_path(full_path))
 		params = {}
@@ -52,3 +139,12 @@ class DropboxClient():
 		}
 		url, params, headers = self.request(path, params, method="GET")
 		return self.connection.get(url, headers)
+
+	def delta(self, cursor=None, path_prefix=None):
+		params = {}
+		if cursor is not None:
+			params["cursor"] = cursor
+		if path_prefix is not None:
+			params["path_prefix"] = DropboxUtil.format_path(path_prefix)
+		url, params, headers = self.request("/delta", params, method="POST")
+		return self.connection.post(url, params, headers)
@@ -1,30 +1,26 @@
 import json
 import socket
 from ..urllib3 import *
+from ..drsync_pool import *
+from ..drsync_retry import *
+from ..drsync_throttle import *
 from .dropbox_util import *
 
+DROPBOX_POOL = SharedPoolManager(num_pools=4, maxsize=8, timeout=60.0)
+
+
 class DropboxConnection():
+	def __init__(self, retry_policy=None):
+		self.retry_policy = retry_policy or RetryPolicy()
 
-	def request(self, method, url, params=None, body=None, headers=None, raw_response=False):
-		try:
-			import ssl
-			pool_manager = PoolManager(
-				num_pools=4,
-				maxsize=8,
-				block=False,
-				timeout=60.0,
-				cert_reqs=ssl.CERT_REQUIRED,
-				ca_certs=DropboxUtil.get_cert_file(),
-				ssl_version=ssl.PROTOCOL_TLSv1,
-			)
-		except (ImportError):
-			pool_manager = PoolManager(
-				num_pools=4,
-				maxsize=8,
-				block=False,
-				timeout=60.0,
-			)
+	@staticmethod
+	def get_pool():
+		ssl_context = DropboxUtil.get_ssl_context()
+		if DROPBOX_POOL.connection_pool_kw.get("ssl_context", False) is not ssl_context:
+			DROPBOX_POOL.configure(ssl_context=ssl_context)
+		return DROPBOX_POOL
 
+	def request(self, method, url, params=None, body=None, headers=None, raw_response=False):
 		params = params or {}
 		headers = headers or {}
 		headers["User-Agent"] = "DrSync/0.1"
@@ -43,17 +39,26 @@ class DropboxConnection():
 			if type(value) == str and "\n" in value:
 				raise ValueError("headers should not contain newlines (" + key + ": " + value + ")")
 
-		try:
-			response = pool_manager.urlopen(method=method, url=url, body=body, headers=headers, preload_content=False)
-		except socket.error as e:
-			raise SocketError(url, e)
-		except exceptions.SSLError as e:
-			raise SocketError(url, "SSL certificate error: %s" % e)
-
-		if response.status != 200:
-			raise ErrorResponse(response, response.read())
-
-		return self.process_response(response, raw_response)
+		offset = body.tell() if hasattr(body, "seek") else None
+		attempt = 0
+		while True:
+			if offset is not None:
+				body.seek(offset)
+			try:
+				response = self.get_pool().urlopen(method=method, url=url, body=UPLOAD_BUCKET.wrap_body(body, headers), headers=headers, preload_content=False)
+			except socket.error as e:
+				raise SocketError(url, e)
+			except exceptions.SSLError as e:
+				raise SocketError(url, "SSL certificate error: %s" % e)
+
+			if response.status == 200:
+				break
+			error = ErrorResponse(response, response.read())
+			if not self.retry_policy.wait(error, attempt):
+				raise error
+			attempt += 1
+
+		return self.process_response(DOWNLOAD_BUCKET.wrap_response(response), raw_response)
 
 	def process_response(self, r, raw_response):
 		if raw_response:
@@ -2,6 +2,7 @@ import re
 import os
 import sublime
 import urllib
+from ..drsync_pool import SSLContextCache
 
 class DropboxUtil():
 	API_VERSION = 1
@@ -10,7 +11,11 @@ class DropboxUtil():
 	API_CONTENT_HOST = "api-content.dropbox.com"
 
 	@staticmethod
-	def get_cert_file():
+	def invalidate_cert_file():
+		DropboxUtil.CERT_CACHE.invalidate()
+
+	@staticmethod
+	def resolve_cert_file():
 		certs = sublime.find_resources("*.crt")
 		for cert in certs:
 			certparent = os.path.dirname(cert)
@@ -20,15 +25,30 @@ class DropboxUtil():
 		parent = os.path.join(sublime.packages_path(), "User", "DrSync")
 		certs = sublime.find_resources("dropbox.certification")
 		for cert in certs:
+			content = sublime.load_resource(cert)
+			certfile = os.path.join(parent, "dropbox.crt")
+			if os.path.exists(certfile):
+				r = open(certfile, "r")
+				existing = r.read()
+				r.close()
+				if existing == content:
+					return certfile
 			if not os.path.exists(parent):
 				os.makedirs(parent)
-			certfile = os.path.join(parent, "dropbox.crt")
 			w = open(certfile, "w")
-			w.write(sublime.load_resource(cert))
+			w.write(content)
 			w.close()
 			return certfile
 		return ""
 
+	@staticmethod
+	def get_cert_file():
+		return DropboxUtil.CERT_CACHE.get_cert_file()
+
+	@staticmethod
+	def get_ssl_context():
+		return DropboxUtil.CERT_CACHE.get_ssl_context()
+
 	@staticmethod
 	def build_path(target, params=None):
 		target_path = urllib.parse.quote(target)
@@ -66,3 +86,5 @@ class DropboxUtil():
 		else:
 			split_paths = DropboxUtil.split_path(path)
 			return "/" + "/".join(split_paths)
+
+DropboxUtil.CERT_CACHE = SSLContextCache(DropboxUtil.resolve_cert_file)
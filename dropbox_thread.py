@@ -1,9 +1,19 @@
+import hashlib
 import threading
-from tempfile import gettempdir
+from tempfile import gettempdir, TemporaryFile
 from .dropbox import *
+from .drsync_atomic import *
+from .drsync_bundle import *
+from .drsync_chunk_store import *
+from .drsync_filter import *
+from .drsync_manifest import *
+from .drsync_transfer import *
 
 
 DROPBOX_SYNC_SCHEMA = "/DrSync.drsync-data"
+DROPBOX_SYNC_BUNDLE = "/" + BUNDLE_FILENAME
+DROPBOX_SYNC_MANIFEST = "/" + MANIFEST_FILENAME
+DOWNLOAD_BLOCK_SIZE = 65536
 
 
 class DropboxPreAuthenticationThread(threading.Thread):
@@ -47,54 +57,198 @@ class DropboxAuthenticationThread(threading.Thread):
 
 
 class DropboxSyncUpThread(threading.Thread):
-	def __init__(self, data, file_list, client):
+	def __init__(self, data, file_list, client, previous_data=None, transfer_settings=None):
 		self.data = data
 		self.file_list = file_list
 		self.client = client
+		self.previous_data = previous_data
+		self.transfer_settings = transfer_settings
 		self.percentage = 0
 		threading.Thread.__init__(self)
 
+	def on_progress(self, engine, name):
+		self.percentage = engine.percentage()
+		self.progress = engine.describe()
+		if name is not None:
+			self.filename = name
+
+	def on_retry(self, policy, delay, error):
+		self.progress = "Retrying in %.1fs, %s" % (delay, policy.describe())
+
+	def upload_name(self, item):
+		return os.path.basename(item[1])
+
+	def upload_size(self, item):
+		if len(item) > 3:
+			return item[2]
+		return os.path.getsize(item[1])
+
+	def upload_file(self, item):
+		parent, filepath = item[:2]
+		path = os.path.join(os.path.basename(parent), os.path.relpath(filepath, parent))
+		f = open(filepath, "rb")
+		try:
+			file_data = self.client.put_file(DropboxUtil.format_path(path), f)
+		finally:
+			f.close()
+		if file_data is not None and "rev" in file_data:
+			self.local_manifest.entries[SyncManifest.relative_path(parent, filepath)]["rev"] = file_data["rev"]
+
+	def upload_chunked_file(self, item):
+		parent, filepath = item[:2]
+		chunk_ids = self.chunk_store.store_file(filepath)
+		self.local_manifest.entries[SyncManifest.relative_path(parent, filepath)]["chunks"] = chunk_ids
+
+	def put_chunk(self, path, f):
+		self.client.put_file(DropboxUtil.format_path(path), f)
+
+	def delete_file(self, path):
+		self.client.delete_file(DropboxUtil.format_path(path))
+
+	def delete_chunk(self, chunk_id):
+		self.delete_file(ChunkStore.chunk_path(chunk_id))
+
+	def chunk_garbage(self, remote_manifest, local_manifest):
+		delta = DropboxDeltaCache.load()
+		try:
+			delta.update(self.client)
+		except Exception as e:
+			return ChunkStore.garbage(remote_manifest, local_manifest)
+		delta.save()
+		return ChunkStore.sweep([record[0] for record in delta.files_under("/" + CHUNK_FOLDER)], local_manifest)
+
+	def bundle_name(self, record):
+		self.filename = os.path.basename(record[1])
+		return SyncManifest.relative_path(record[0], record[1])
+
+	def put_bundle(self, bundle):
+		bundle.seek(0)
+		self.client.put_file(DROPBOX_SYNC_BUNDLE, bundle)
+
+	def upload_bundle(self, engine):
+		bundle = SyncBundle.build(self.file_list, self.bundle_name)
+		try:
+			engine.run([bundle], self.put_bundle, lambda item: DROPBOX_SYNC_BUNDLE)
+		finally:
+			bundle.close()
+
+	def get_remote_manifest(self):
+		try:
+			fp = self.client.get_file(DROPBOX_SYNC_MANIFEST)
+		except ErrorResponse as e:
+			if e.status == 404:
+				return SyncManifest()
+			raise e
+		return SyncManifest.decode(fp.read().decode("utf-8"))
+
+	def put_data(self, full_path, data):
+		tmppath = os.path.join(gettempdir(), "DrSync.drsync-tmp")
+		out = open(tmppath, "wb")
+		out.write(data.encode("utf-8"))
+		out.close()
+		f = open(tmppath, "rb")
+		self.client.put_file(full_path, f)
+		f.close()
+
 	def run(self):
 		currentfile = ""
 		try:
-			index = 0
-			for parent, filepath in self.file_list:
-				self.percentage = int(index*100/(len(self.file_list)+1))
-				currentfile = os.path.basename(filepath)
-				self.filename = currentfile
-				path = os.path.join(os.path.basename(parent), os.path.relpath(filepath, parent))
-				f = open(filepath, "rb")
-				self.client.put_file(DropboxUtil.format_path(path), f)
-				index += 1
-			self.percentage = int(index*100/(len(self.file_list)+1))
-			tmppath = os.path.join(gettempdir(), "DrSync.drsync-tmp")
-			out = open(tmppath, "wb")
-			out.write(sublime.encode_value(self.data).encode("utf-8"))
-			out.close()
-			f = open(tmppath, "rb")
-			self.client.put_file(DROPBOX_SYNC_SCHEMA, f)
+			self.filename = "Preparing"
+			self.retry_policy = self.client.configure_retries(self.transfer_settings, self.on_retry)
+			self.client.configure_uploads(self.transfer_settings)
+			remote_manifest = self.get_remote_manifest()
+			local_manifest = SyncManifest.from_files(self.file_list, SyncManifest.load_local())
+			layout = self.data.get("layout", "files")
+			if layout == "bundle":
+				local_manifest.mark_bundled()
+			changed, removed = local_manifest.diff(remote_manifest, layout)
+			changed_paths = set(changed)
+			upload_list = [record for record in self.file_list if SyncManifest.relative_path(record[0], record[1]) in changed_paths]
+			if len(upload_list) == 0 and len(removed) == 0 and self.previous_data is not None and self.previous_data["settings"] == self.data["settings"]:
+				local_manifest.save_local()
+				self.percentage = 100
+				self.result = True
+				return
+			remote_layouts = dict([(path, SyncManifest.layout_of(entry)) for path, entry in remote_manifest.entries.items()])
+			removed_files = [path for path in removed + changed if remote_layouts.get(path) == "files" and (layout != "files" or path not in local_manifest.entries)]
+			engine = TransferEngine.from_settings(self.transfer_settings, self.on_progress, self.retry_policy)
+			engine.add_total((1 if layout == "bundle" else len(upload_list)) + len(removed_files) + 1)
+			self.local_manifest = local_manifest
+			if layout == "bundle":
+				self.filename = "Bundling"
+				self.upload_bundle(engine)
+			elif layout == "chunks":
+				self.chunk_store = ChunkStore(put_object=self.put_chunk, known=ChunkStore.referenced(remote_manifest))
+				engine.run(upload_list, self.upload_chunked_file, self.upload_name, weight_fx=self.upload_size)
+			else:
+				engine.run(upload_list, self.upload_file, self.upload_name, weight_fx=self.upload_size)
+			engine.run(removed_files, self.delete_file, os.path.basename)
+			if layout == "chunks" or "chunks" in remote_layouts.values():
+				self.filename = "Sweeping chunks"
+				garbage = self.chunk_garbage(remote_manifest, local_manifest)
+				engine.add_total(len(garbage))
+				engine.run(garbage, self.delete_chunk)
+			if layout != "bundle" and "bundle" in remote_layouts.values():
+				self.delete_file(DROPBOX_SYNC_BUNDLE)
+			self.put_data(DROPBOX_SYNC_MANIFEST, local_manifest.encode())
+			self.put_data(DROPBOX_SYNC_SCHEMA, sublime.encode_value(self.data))
+			engine.report(os.path.basename(DROPBOX_SYNC_SCHEMA))
+			local_manifest.save_local()
 
 			self.result = True
 		except Exception as e:
+			if isinstance(e, TransferError):
+				currentfile = e.name
 			self.result_message = "Dropbox Error [U] on %s: %s" % (currentfile, e)
 			self.result = False
 			self.exception = e
 
 
 class DropboxSyncGatherThread(threading.Thread):
-	def __init__(self, paths, data, client):
+	def __init__(self, paths, data, client, transfer_settings=None, filter_engine=None):
 		self.paths = paths
 		self.data = data
 		self.client = client
+		self.transfer_settings = transfer_settings or {}
+		self.filter_engine = filter_engine or FilterEngine()
+		self.delta = None
 		threading.Thread.__init__(self)
 
-	def is_exists(self, file_path):
+	def get_delta(self):
+		if not self.transfer_settings.get("fast_gather", True):
+			return None
+		delta = DropboxDeltaCache.load()
+		try:
+			delta.update(self.client)
+		except Exception as e:
+			if delta.cursor is None:
+				return None
+			delta.reset()
+			try:
+				delta.update(self.client)
+			except Exception as e:
+				return None
+		delta.save()
+		return delta
+
+	def gather_folder(self, dir_path):
+		if self.delta is not None:
+			return self.delta.files_under(dir_path)
+		return self.get_all(dir_path)
+
+	def gather_file(self, file_path):
+		if self.delta is not None:
+			return self.delta.get(file_path)
+		return self.get_metadata(file_path)
+
+	def get_metadata(self, file_path):
 		try:
 			filedata = self.client.metadata(file_path)
-			return "is_deleted" not in filedata or not filedata["is_deleted"]
+			if "is_deleted" not in filedata or not filedata["is_deleted"]:
+				return filedata
 		except Exception as e:
-			return False
-		return False
+			return None
+		return None
 
 	def get_all(self, dir_path):
 		file_list = []
@@ -102,41 +256,78 @@ class DropboxSyncGatherThread(threading.Thread):
 			folderdata = self.client.metadata(dir_path)
 			for item in folderdata["contents"]:
 				if item["is_dir"]:
-					file_list += self.get_all(item["path"])
+					if not self.filter_engine.match(item["path"], True):
+						file_list += self.get_all(item["path"])
 				else:
-					file_list.append(item["path"])
+					file_list.append([item["path"], item.get("bytes", 0), item.get("rev")])
 		except Exception as e:
 			pass
 		return file_list
 
+	def get_user_files(self, settings):
+		files = []
+		if settings["package_control_preferences"]:
+			files += ["Package Control.sublime-settings"]
+		if settings["drsync_preferences"]:
+			files += ["DrSync.sublime-settings"]
+		if settings["sublime_preferences"]:
+			files += ["Preferences.sublime-settings", "Default (Windows).sublime-keymap", "Default (OSX).sublime-keymap", "Default (Linux).sublime-keymap"]
+		return files
+
+	def get_manifest(self):
+		try:
+			fp = self.client.get_file(DROPBOX_SYNC_MANIFEST)
+		except ErrorResponse as e:
+			if e.status == 404:
+				return SyncManifest()
+			raise e
+		return SyncManifest.decode(fp.read().decode("utf-8"))
+
+	def gather_manifest(self, layout):
+		settings = self.data["settings"]
+		roots = {}
+		if settings["installed_packages"]:
+			roots[os.path.basename(self.paths["installed_packages"])] = (self.paths["installed_packages"], None)
+		if settings["local_packages"]:
+			roots[os.path.basename(self.paths["packages"])] = (self.paths["packages"], None)
+		if settings["user_directory"]:
+			roots[os.path.basename(self.paths["packages_user"])] = (self.paths["packages_user"], None)
+		else:
+			roots[os.path.basename(self.paths["packages_user"])] = (self.paths["packages_user"], self.get_user_files(settings))
+		file_list = []
+		for target, path, entry in self.get_manifest().select(roots, layout):
+			file_list.append([target, DropboxUtil.format_path(path), entry["size"], entry.get("chunks"), {"size": entry["size"], "hash": entry["hash"]}])
+		return file_list
+
 	def run(self):
 		try:
+			self.client.configure_retries(self.transfer_settings)
 			self.file_list = []
-			settings = self.data["settings"]
-			if settings["installed_packages"]:
-				files = self.get_all(DropboxUtil.format_path(os.path.basename(self.paths["installed_packages"])))
-				for filepath in files:
-					self.file_list.append([self.paths["installed_packages"], filepath])
-			if settings["local_packages"]:
-				files = self.get_all(DropboxUtil.format_path(os.path.basename(self.paths["packages"])))
-				for filepath in files:
-					self.file_list.append([self.paths["packages"], filepath])
-			if settings["user_directory"]:
-				files = self.get_all(DropboxUtil.format_path(os.path.basename(self.paths["packages_user"])))
-				for filepath in files:
-					self.file_list.append([self.paths["packages_user"], filepath])
+			if self.data.get("layout", "files") != "files":
+				self.file_list = self.gather_manifest(self.data["layout"])
 			else:
-				files = []
-				if settings["package_control_preferences"]:
-					files += ["Package Control.sublime-settings"]
-				if settings["drsync_preferences"]:
-					files += ["DrSync.sublime-settings"]
-				if settings["sublime_preferences"]:
-					files += ["Preferences.sublime-settings", "Default (Windows).sublime-keymap", "Default (OSX).sublime-keymap", "Default (Linux).sublime-keymap"]
-				for filename in files:
-					filepath = os.path.join(os.path.basename(self.paths["packages_user"]), filename)
-					if self.is_exists(DropboxUtil.format_path(filepath)):
-						self.file_list.append([self.paths["packages_user"], DropboxUtil.format_path(filepath)])
+				self.delta = self.get_delta()
+				settings = self.data["settings"]
+				if settings["installed_packages"]:
+					files = self.gather_folder(DropboxUtil.format_path(os.path.basename(self.paths["installed_packages"])))
+					for filepath, size, rev in files:
+						self.file_list.append([self.paths["installed_packages"], filepath, size, None, {"size": size, "rev": rev}])
+				if settings["local_packages"]:
+					files = self.gather_folder(DropboxUtil.format_path(os.path.basename(self.paths["packages"])))
+					for filepath, size, rev in files:
+						self.file_list.append([self.paths["packages"], filepath, size, None, {"size": size, "rev": rev}])
+				if settings["user_directory"]:
+					files = self.gather_folder(DropboxUtil.format_path(os.path.basename(self.paths["packages_user"])))
+					for filepath, size, rev in files:
+						self.file_list.append([self.paths["packages_user"], filepath, size, None, {"size": size, "rev": rev}])
+				else:
+					for filename in self.get_user_files(settings):
+						filepath = os.path.join(os.path.basename(self.paths["packages_user"]), filename)
+						file_data = self.gather_file(DropboxUtil.format_path(filepath))
+						if file_data is not None:
+							size = file_data.get("bytes", 0)
+							self.file_list.append([self.paths["packages_user"], DropboxUtil.format_path(filepath), size, None, {"size": size, "rev": file_data.get("rev")}])
+			self.file_list = [item for item in self.file_list if not self.filter_engine.is_excluded(item[1])]
 			self.result = True
 		except Exception as e:
 			self.result_message = "Dropbox Error [G] gathering: %s" % (e)
@@ -145,33 +336,151 @@ class DropboxSyncGatherThread(threading.Thread):
 
 
 class DropboxSyncDownThread(threading.Thread):
-	def __init__(self, data, file_list, client):
+	def __init__(self, data, file_list, client, transfer_settings=None):
 		self.data = data
 		self.file_list = file_list
 		self.client = client
+		self.transfer_settings = transfer_settings
+		self.fsync = (transfer_settings or {}).get("fsync", False)
 		self.percentage = 0
 		threading.Thread.__init__(self)
 
+	def on_progress(self, engine, name):
+		self.percentage = engine.percentage()
+		self.progress = engine.describe()
+		if name is not None:
+			self.filename = name
+
+	def on_retry(self, policy, delay, error):
+		self.progress = "Retrying in %.1fs, %s" % (delay, policy.describe())
+
+	def target_path(self, target, filepath):
+		targetname = DropboxUtil.format_path(os.path.basename(target))
+		return os.path.join(target, filepath[len(targetname)+1:])
+
+	def download_name(self, item):
+		return os.path.basename(item[1])
+
+	def download_size(self, item):
+		return item[2]
+
+	def manifest_path(self, item):
+		return SyncManifest.relative_path(item[0], self.target_path(item[0], item[1]))
+
+	def is_unchanged(self, item):
+		return self.local_manifest.matches(self.manifest_path(item), self.target_path(item[0], item[1]), item[4])
+
+	def download_file(self, item):
+		target, filepath, size, chunk_ids, remote = item
+		name = os.path.basename(filepath)
+		md5 = hashlib.md5()
+		written = 0
+		try:
+			f = self.client.get_file(filepath)
+			out = AtomicFile(self.target_path(target, filepath), self.fsync)
+			try:
+				for block in f.stream(DOWNLOAD_BLOCK_SIZE):
+					out.write(block)
+					md5.update(block)
+					written += len(block)
+					self.engine.add_transferred(len(block), name)
+				out.commit()
+			finally:
+				out.close()
+				f.release_conn()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+		self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote, md5.hexdigest())
+
+	def get_chunk(self, path):
+		return self.client.get_file(DropboxUtil.format_path(path))
+
+	def download_chunked_file(self, item):
+		target, filepath, size, chunk_ids, remote = item
+		name = os.path.basename(filepath)
+		written = 0
+		def on_data(length):
+			nonlocal written
+			written += length
+			self.engine.add_transferred(length, name)
+		try:
+			out = AtomicFile(self.target_path(target, filepath), self.fsync)
+			try:
+				self.chunk_store.restore_file(chunk_ids, out, on_data)
+				out.commit()
+			finally:
+				out.close()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+		self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote)
+
+	def fetch_bundle(self, bundle):
+		bundle.seek(0)
+		bundle.truncate()
+		written = 0
+		try:
+			f = self.client.get_file(DROPBOX_SYNC_BUNDLE)
+			try:
+				for block in f.stream(DOWNLOAD_BLOCK_SIZE):
+					bundle.write(block)
+					written += len(block)
+					self.engine.add_transferred(len(block), DROPBOX_SYNC_BUNDLE)
+			finally:
+				f.release_conn()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+
+	def download_bundle(self):
+		file_data = self.client.metadata(DROPBOX_SYNC_BUNDLE)
+		self.engine.add_total(0, file_data.get("bytes", 0))
+		tmp = TemporaryFile()
+		try:
+			self.engine.run([tmp], self.fetch_bundle, lambda item: DROPBOX_SYNC_BUNDLE, counted=False)
+			tmp.seek(0)
+			bundle = SyncBundle(tmp)
+		except Exception as e:
+			tmp.close()
+			raise e
+		try:
+			for item in self.download_list:
+				target, filepath, size, chunk_ids, remote = item
+				self.filename = os.path.basename(filepath)
+				bundle.extract(filepath[1:], self.target_path(target, filepath), self.fsync)
+				self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote)
+				self.engine.report(self.filename, size)
+		finally:
+			bundle.close()
+
 	def run(self):
 		currentfile = ""
 		try:
-			index = 0
-			for target, filepath in self.file_list:
-				currentfile = os.path.basename(filepath)
-				self.filename = currentfile
-				self.percentage = int(index*100/len(self.file_list))
-				targetname = DropboxUtil.format_path(os.path.basename(target))
-				targetpath = os.path.join(target, filepath[len(targetname)+1:])
-				targetdir = os.path.dirname(targetpath)
-				f = self.client.get_file(filepath)
+			self.filename = "Comparing"
+			self.retry_policy = self.client.configure_retries(self.transfer_settings, self.on_retry)
+			self.local_manifest = SyncManifest.load_local()
+			self.download_list = [item for item in self.file_list if not self.is_unchanged(item)]
+			self.chunk_store = ChunkStore(get_object=self.get_chunk)
+			self.engine = TransferEngine.from_settings(self.transfer_settings, self.on_progress, self.retry_policy)
+			self.engine.add_total(len(self.download_list), sum([item[2] for item in self.download_list]))
+			targetdirs = set([os.path.dirname(self.target_path(item[0], item[1])) for item in self.download_list])
+			for targetdir in sorted(targetdirs):
 				if not os.path.exists(targetdir):
 					os.makedirs(targetdir)
-				out = open(targetpath, "wb")
-				out.write(f.read())
-				out.close()
-				index += 1
+			if len(self.download_list) == 0:
+				self.percentage = 100
+			elif self.data.get("layout") == "bundle":
+				self.download_bundle()
+			elif self.data.get("layout") == "chunks":
+				self.engine.run(self.download_list, self.download_chunked_file, self.download_name, weight_fx=self.download_size)
+			else:
+				self.engine.run(self.download_list, self.download_file, self.download_name, weight_fx=self.download_size)
+			self.local_manifest.save_local()
 			self.result = True
 		except Exception as e:
+			if isinstance(e, TransferError):
+				currentfile = e.name
 			self.result_message = "Dropbox Error [D] on %s: %s" % (currentfile, e)
 			self.result = False
 			self.exception = e
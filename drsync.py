@@ -2,19 +2,24 @@ import sublime
 import sublime_plugin
 import datetime
 import os
-import re
 from .dropbox import *
 from .gdrive import *
 from .dropbox_thread import *
 from .gdrive_thread import *
+from .drsync_atomic import *
+from .drsync_filter import *
 from .drsync_key import *
+from .drsync_scanner import *
+from .drsync_throttle import *
 from .thread_progress import *
 
 
 VERSION = "0.1.10"
 SETTINGSBASE = "DrSync.sublime-settings"
 USER_FOLDER = "User"
+DRSYNC_FOLDER = "DrSync"
 DRSYNC_SETTINGS = None
+BANDWIDTH_PRESETS = [0, 64, 256, 1024, 4096]
 
 
 def get_settings(key, default=None):
@@ -27,9 +32,23 @@ def set_settings(key, value):
 def cloud_is(cloud):
 	return get_settings("cloud_service") == cloud
 
+def configure_throttle():
+	limits = get_settings("bandwidth_limit") or {}
+	UPLOAD_BUCKET.configure(limits.get("upload", 0) * 1024)
+	DOWNLOAD_BUCKET.configure(limits.get("download", 0) * 1024)
+
+def format_limit(limit):
+	if limit <= 0:
+		return "Unlimited"
+	return "%s/s" % (TransferEngine.format_size(limit * 1024))
+
 def plugin_loaded():
 	global DRSYNC_SETTINGS
 	DRSYNC_SETTINGS = sublime.load_settings(SETTINGSBASE)
+	DRSYNC_SETTINGS.add_on_change("bandwidth_limit", configure_throttle)
+	configure_throttle()
+	GDriveUtil.invalidate_cert_file()
+	DropboxUtil.invalidate_cert_file()
 	print("DrSync v%s ready" % (VERSION))
 
 
@@ -53,9 +72,28 @@ class DrsyncCommand(sublime_plugin.WindowCommand):
 		filename = ""
 		if hasattr(thread, "filename"):
 			filename = " "+thread.filename
+		if hasattr(thread, "progress"):
+			filename = " (%s)%s" % (thread.progress, filename)
+		bucket = UPLOAD_BUCKET if self.upload else DOWNLOAD_BUCKET
+		if bucket.is_limited():
+			filename = " [%s/s]%s" % (TransferEngine.format_size(bucket.rate), filename)
 		return {"i": (i+1) % maxsize, "message": "Syncing... [{0}] {1}%{2}{3}".format("".join(loadbar), thread.percentage, filename, "."*(1+(i%3))), "delay": 300}
 
+	def configure_pool(self):
+		pool_settings = get_settings("connection_pool") or {}
+		transfer_settings = get_settings("transfer_settings") or {}
+		workers = transfer_settings.get("concurrency", 4)
+		if transfer_settings.get("adaptive_concurrency", True):
+			workers = max(workers, transfer_settings.get("max_concurrency", 16))
+		maxsize = max(pool_settings.get("max_connections_per_host", 8), workers)
+		idle_timeout = pool_settings.get("idle_timeout", 60)
+		if cloud_is("drive"):
+			GDriveConnection.get_pool().configure(maxsize=maxsize, idle_timeout=idle_timeout)
+		elif cloud_is("dropbox"):
+			DropboxConnection.get_pool().configure(maxsize=maxsize, idle_timeout=idle_timeout)
+
 	def run(self):
+		self.configure_pool()
 		credential = DrSyncCredential.get_credential(self, get_settings("cloud_service"))
 		refresh_token = get_settings("refresh_token")
 
@@ -144,38 +182,17 @@ class DrsyncCommand(sublime_plugin.WindowCommand):
 		else:
 			self.sync_from()
 
-	def match_regex(self, string, key):
-		patterns = get_settings(key)
-		for pattern in patterns:
-			matches = re.match(pattern, string)
-			if matches is not None and matches.start() == 0:
-				return True
-		return False
-
-	def add_all(self, dir_path, subdir=True, folder_filter=None, file_filter=None, base_path=None):
-		files = []
-		for name in os.listdir(dir_path):
-			pathname = os.path.join(dir_path, name)
-			if subdir and os.path.isdir(pathname) and not self.match_regex(name, "exclude_folder_patterns") and (folder_filter is None or (folder_filter is not None and folder_filter(name))):
-				if base_path is None:
-					files += self.add_all(pathname, subdir, folder_filter, file_filter, dir_path)
-				else:
-					files += self.add_all(pathname, subdir, folder_filter, file_filter, base_path)
-			elif os.path.isfile(pathname) and not self.match_regex(name, "exclude_file_patterns") and (file_filter is None or (file_filter is not None and file_filter(name))):
-				if base_path is None:
-					files.append([dir_path, pathname])
-				else:
-					files.append([base_path, pathname])
-		return files
-
 	def user_folder_exclude_filter(self, name):
 		return name != USER_FOLDER
 
+	def get_filter_engine(self):
+		return FilterEngine.from_settings(get_settings, ["%s/%s/" % (USER_FOLDER, DRSYNC_FOLDER), ATOMIC_GLOB])
+
 	def sync_from(self):
 		if cloud_is("drive"):
-			thread = GDriveSyncGatherThread(self.paths, self.sync_data, self.client)
+			thread = GDriveSyncGatherThread(self.paths, self.sync_data, self.client, get_settings("transfer_settings"), self.get_filter_engine())
 		elif cloud_is("dropbox"):
-			thread = DropboxSyncGatherThread(self.paths, self.sync_data, self.client)
+			thread = DropboxSyncGatherThread(self.paths, self.sync_data, self.client, get_settings("transfer_settings"), self.get_filter_engine())
 		thread.start()
 		self.upload = False
 		ThreadProgress(thread, "DrSync is verifying data", self.on_verified, self.on_verified, self.connect_fx)
@@ -183,9 +200,9 @@ class DrsyncCommand(sublime_plugin.WindowCommand):
 	def on_verified(self, thread):
 		if thread.result:
 			if cloud_is("drive"):
-				sthread = GDriveSyncDownThread(self.sync_data, thread.file_list, self.client)
+				sthread = GDriveSyncDownThread(self.sync_data, thread.file_list, self.client, get_settings("transfer_settings"))
 			elif cloud_is("dropbox"):
-				sthread = DropboxSyncDownThread(self.sync_data, thread.file_list, self.client)
+				sthread = DropboxSyncDownThread(self.sync_data, thread.file_list, self.client, get_settings("transfer_settings"))
 			sthread.start()
 			self.upload = False
 			ThreadProgress(sthread, "", self.on_sync_done, self.on_sync_done, self.sync_fx)
@@ -195,14 +212,15 @@ class DrsyncCommand(sublime_plugin.WindowCommand):
 
 	def sync_to(self):
 		file_list = []
+		scanner = LocalScanner(self.get_filter_engine())
 
 		settings = get_settings("synchronization_settings")
 		if settings["installed_packages"]:
-			file_list += self.add_all(dir_path=self.paths["installed_packages"])
+			file_list.extend(scanner.scan(self.paths["installed_packages"]))
 		if settings["local_packages"]:
-			file_list += self.add_all(dir_path=self.paths["packages"], folder_filter=self.user_folder_exclude_filter)
+			file_list.extend(scanner.scan(self.paths["packages"], folder_filter=self.user_folder_exclude_filter))
 		if settings["user_directory"]:
-			file_list += self.add_all(dir_path=self.paths["packages_user"])
+			file_list.extend(scanner.scan(self.paths["packages_user"]))
 		else:
 			files = []
 			if settings["package_control_preferences"]:
@@ -212,25 +230,53 @@ class DrsyncCommand(sublime_plugin.WindowCommand):
 			if settings["sublime_preferences"]:
 				files += ["Preferences.sublime-settings", "Default (Windows).sublime-keymap", "Default (OSX).sublime-keymap", "Default (Linux).sublime-keymap"]
 			for filename in files:
-				filepath = os.path.join(self.paths["packages_user"], filename)
-				if os.path.exists(filepath):
-					file_list.append([self.paths["packages_user"], filepath])
+				record = scanner.stat_file(self.paths["packages_user"], os.path.join(self.paths["packages_user"], filename))
+				if record is not None:
+					file_list.append(record)
 
 		data = {}
 		data["settings"] = settings
 		data["last_sync"] = self.get_timestamp()
+		data["layout"] = (get_settings("transfer_settings") or {}).get("storage_layout", "files")
 
 		if cloud_is("drive"):
-			thread = GDriveSyncUpThread(data, file_list, self.client)
+			thread = GDriveSyncUpThread(data, file_list, self.client, self.sync_data, get_settings("transfer_settings"))
 		elif cloud_is("dropbox"):
-			thread = DropboxSyncUpThread(data, file_list, self.client)
+			thread = DropboxSyncUpThread(data, file_list, self.client, self.sync_data, get_settings("transfer_settings"))
 		thread.start()
 		self.upload = True
 		ThreadProgress(thread, "", self.on_sync_done, self.on_sync_done, self.sync_fx)
 
 	def on_sync_done(self, thread):
+		if get_settings("debug_mode"):
+			if cloud_is("drive"):
+				print("DrSync connection pool: %s" % (GDriveConnection.get_pool().statistics()))
+			elif cloud_is("dropbox"):
+				print("DrSync connection pool: %s" % (DropboxConnection.get_pool().statistics()))
 		if thread.result:
 			sublime.status_message("Data has been synchronized successfully")
 		else:
 			sublime.error_message(thread.result_message)
 			raise thread.exception
+
+
+class DrsyncBandwidthCommand(sublime_plugin.WindowCommand):
+	def run(self):
+		limits = get_settings("bandwidth_limit") or {}
+		self.items = []
+		items = []
+		for direction in ["upload", "download"]:
+			for limit in BANDWIDTH_PRESETS:
+				self.items.append([direction, limit])
+				items.append(["%s: %s" % (direction.capitalize(), format_limit(limit)), "Current: %s" % (format_limit(limits.get(direction, 0)))])
+		self.window.show_quick_panel(items, self.on_select)
+
+	def on_select(self, index):
+		if index < 0:
+			return
+		direction, limit = self.items[index]
+		limits = dict(get_settings("bandwidth_limit") or {})
+		limits[direction] = limit
+		set_settings("bandwidth_limit", limits)
+		configure_throttle()
+		sublime.status_message("DrSync %s limit: %s" % (direction, format_limit(limit)))
@@ -0,0 +1,58 @@
+import os
+import stat
+import uuid
+
+
+ATOMIC_PREFIX = ".drsync-"
+ATOMIC_SUFFIX = ".tmp"
+ATOMIC_GLOB = ATOMIC_PREFIX + "*" + ATOMIC_SUFFIX
+ATOMIC_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+ATOMIC_ATTEMPTS = 100
+
+
+class AtomicFile():
+	def __init__(self, target_path, fsync=False):
+		self.target_path = target_path
+		self.fsync = fsync
+		self.committed = False
+		fd, self.temp_path = AtomicFile.create_temp(os.path.dirname(target_path))
+		self.file = os.fdopen(fd, "wb")
+
+	@staticmethod
+	def create_temp(parent):
+		for attempt in range(ATOMIC_ATTEMPTS):
+			temp_path = os.path.join(parent, ATOMIC_PREFIX + uuid.uuid4().hex + ATOMIC_SUFFIX)
+			try:
+				return os.open(temp_path, ATOMIC_FLAGS, 0o666), temp_path
+			except FileExistsError:
+				continue
+		raise FileExistsError("no usable temporary name in %s" % (parent))
+
+	def target_mode(self):
+		try:
+			return stat.S_IMODE(os.stat(self.target_path).st_mode)
+		except OSError:
+			return None
+
+	def write(self, data):
+		return self.file.write(data)
+
+	def commit(self):
+		self.file.flush()
+		if self.fsync:
+			os.fsync(self.file.fileno())
+		self.file.close()
+		mode = self.target_mode()
+		if mode is not None:
+			os.chmod(self.temp_path, mode)
+		os.replace(self.temp_path, self.target_path)
+		self.committed = True
+
+	def close(self):
+		if self.committed:
+			return
+		self.file.close()
+		try:
+			os.remove(self.temp_path)
+		except OSError:
+			pass
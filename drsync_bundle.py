@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from .drsync_atomic import *
+
+
+BUNDLE_FILENAME = "DrSync.drsync-bundle"
+BUNDLE_BLOCK_SIZE = 65536
+
+
+class SyncBundle():
+	def __init__(self, file_obj):
+		self.file_obj = file_obj
+		self.archive = zipfile.ZipFile(file_obj, "r")
+
+	@staticmethod
+	def build(file_list, arcname_fx, on_file=None):
+		out = tempfile.TemporaryFile()
+		try:
+			archive = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED)
+			try:
+				for record in file_list:
+					arcname = arcname_fx(record)
+					archive.write(record[1], arcname)
+					if on_file is not None:
+						on_file(arcname)
+			finally:
+				archive.close()
+		except Exception as e:
+			out.close()
+			raise e
+		out.seek(0)
+		return out
+
+	def extract(self, arcname, target_path, fsync=False):
+		source = self.archive.open(arcname)
+		try:
+			out = AtomicFile(target_path, fsync)
+			try:
+				shutil.copyfileobj(source, out, BUNDLE_BLOCK_SIZE)
+				out.commit()
+			finally:
+				out.close()
+		finally:
+			source.close()
+
+	def names(self):
+		return set(self.archive.namelist())
+
+	def close(self):
+		self.archive.close()
+		self.file_obj.close()
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import tempfile
+import threading
+import zlib
+
+
+CHUNK_FOLDER = "DrSync.chunks"
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVG_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_THRESHOLD = CHUNK_AVG_SIZE
+CHUNK_READ_SIZE = 65536
+CHUNK_ANCHOR = b"\n"
+CHUNK_ANCHOR_RATE = 256
+CHUNK_WINDOW = 32
+
+
+class ContentChunker():
+	def __init__(self, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE, max_size=CHUNK_MAX_SIZE):
+		self.min_size = max(min_size, CHUNK_WINDOW)
+		self.max_size = max(max_size, self.min_size)
+		self.mask = (1 << max(0, (avg_size // CHUNK_ANCHOR_RATE).bit_length() - 1)) - 1
+
+	def find_cut(self, data, start, end):
+		end = min(end, start + self.max_size)
+		if end - start <= self.min_size:
+			return end
+		index = data.find(CHUNK_ANCHOR, start + self.min_size - 1, end)
+		while index >= 0:
+			if not zlib.crc32(data[index-CHUNK_WINDOW+1:index+1]) & self.mask:
+				return index + 1
+			index = data.find(CHUNK_ANCHOR, index + 1, end)
+		return end
+
+	def split(self, file_obj):
+		buffer = bytearray()
+		start = 0
+		eof = False
+		while True:
+			while not eof and len(buffer) - start < self.max_size:
+				block = file_obj.read(self.max_size)
+				if not block:
+					eof = True
+				else:
+					buffer += block
+			if start >= len(buffer):
+				return
+			cut = self.find_cut(buffer, start, len(buffer))
+			yield bytes(buffer[start:cut])
+			start = cut
+			if start >= self.max_size:
+				del buffer[:start]
+				start = 0
+
+
+class ChunkStore():
+	def __init__(self, put_object=None, get_object=None, known=None, chunker=None, threshold=CHUNK_THRESHOLD):
+		self.put_object = put_object
+		self.get_object = get_object
+		self.chunker = chunker or ContentChunker()
+		self.threshold = threshold
+		self.lock = threading.Lock()
+		self.known = set(known or [])
+		self.uploaded_bytes = 0
+
+	@staticmethod
+	def chunk_path(chunk_id):
+		return "%s/%s/%s" % (CHUNK_FOLDER, chunk_id[:2], chunk_id)
+
+	@staticmethod
+	def referenced(manifest):
+		chunk_ids = set()
+		for entry in manifest.entries.values():
+			chunk_ids.update(entry.get("chunks", []))
+		return chunk_ids
+
+	@staticmethod
+	def garbage(old_manifest, new_manifest):
+		return sorted(ChunkStore.referenced(old_manifest) - ChunkStore.referenced(new_manifest))
+
+	@staticmethod
+	def sweep(stored_paths, manifest):
+		referenced = ChunkStore.referenced(manifest)
+		return sorted(set([os.path.basename(path) for path in stored_paths]) - referenced)
+
+	def claim(self, chunk_id):
+		with self.lock:
+			if chunk_id in self.known:
+				return False
+			self.known.add(chunk_id)
+			return True
+
+	def split(self, file_obj):
+		if os.fstat(file_obj.fileno()).st_size < self.threshold:
+			data = file_obj.read()
+			return [data] if len(data) > 0 else []
+		return self.chunker.split(file_obj)
+
+	def store_file(self, filepath):
+		chunk_ids = []
+		f = open(filepath, "rb")
+		try:
+			for chunk in self.split(f):
+				chunk_id = hashlib.sha1(chunk).hexdigest()
+				chunk_ids.append(chunk_id)
+				if not self.claim(chunk_id):
+					continue
+				try:
+					tmp = tempfile.TemporaryFile()
+					try:
+						tmp.write(chunk)
+						tmp.seek(0)
+						self.put_object(self.chunk_path(chunk_id), tmp)
+					finally:
+						tmp.close()
+				except Exception as e:
+					with self.lock:
+						self.known.discard(chunk_id)
+					raise e
+				with self.lock:
+					self.uploaded_bytes += len(chunk)
+		finally:
+			f.close()
+		return chunk_ids
+
+	def restore_file(self, chunk_ids, out, on_data=None):
+		for chunk_id in chunk_ids:
+			sha1 = hashlib.sha1()
+			response = self.get_object(self.chunk_path(chunk_id))
+			try:
+				for block in response.stream(CHUNK_READ_SIZE):
+					sha1.update(block)
+					out.write(block)
+					if on_data is not None:
+						on_data(len(block))
+			finally:
+				response.release_conn()
+			if sha1.hexdigest() != chunk_id:
+				raise ValueError("chunk %s is corrupted" % (chunk_id))
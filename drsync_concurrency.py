@@ -0,0 +1,74 @@
+import threading
+import time
+
+
+LATENCY_TOLERANCE = 4.0
+LATENCY_WEIGHT = 0.2
+LATENCY_UNIT = 256 * 1024
+DECREASE_COOLDOWN = 1.0
+
+
+class ConcurrencyController():
+	def __init__(self, limit=4, minimum=1, maximum=16):
+		self.condition = threading.Condition()
+		self.minimum = minimum
+		self.maximum = max(minimum, maximum)
+		self.limit = min(max(limit, self.minimum), self.maximum)
+		self.active = 0
+		self.successes = 0
+		self.latency = None
+		self.decreased = 0
+		self.configured = None
+
+	def configure(self, limit, maximum):
+		with self.condition:
+			self.maximum = max(self.minimum, maximum)
+			if self.configured != limit:
+				self.limit = limit
+				self.configured = limit
+				self.successes = 0
+			self.limit = min(max(self.limit, self.minimum), self.maximum)
+			self.condition.notify_all()
+
+	def acquire(self):
+		with self.condition:
+			while self.active >= self.limit:
+				self.condition.wait()
+			self.active += 1
+
+	def release(self):
+		with self.condition:
+			self.active -= 1
+			self.condition.notify_all()
+
+	def success(self, duration, size=0):
+		duration = duration / (1.0 + float(size) / LATENCY_UNIT)
+		with self.condition:
+			if self.latency is None:
+				self.latency = duration
+			healthy = duration <= self.latency * LATENCY_TOLERANCE
+			self.latency += (duration - self.latency) * LATENCY_WEIGHT
+			if not healthy:
+				self.successes = 0
+				return
+			self.successes += 1
+			if self.successes >= self.limit and self.limit < self.maximum:
+				self.limit += 1
+				self.successes = 0
+				self.condition.notify_all()
+
+	def decrease(self):
+		with self.condition:
+			now = time.time()
+			if now - self.decreased < DECREASE_COOLDOWN:
+				return
+			self.decreased = now
+			self.limit = max(self.minimum, self.limit // 2)
+			self.successes = 0
+
+	def describe(self):
+		with self.condition:
+			return "%d/%d workers" % (self.active, self.limit)
+
+
+TRANSFER_CONCURRENCY = ConcurrencyController()
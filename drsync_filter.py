@@ -0,0 +1,100 @@
+import re
+
+
+class FilterEngine():
+	def __init__(self, folder_patterns=None, file_patterns=None, globs=None):
+		name_folder = ["(?:%s)" % (pattern) for pattern in folder_patterns or []]
+		name_file = ["(?:%s)" % (pattern) for pattern in file_patterns or []]
+		path_folder = []
+		path_file = []
+		for glob in globs or []:
+			glob = glob.strip()
+			if glob == "" or glob.startswith("#"):
+				continue
+			dir_only = glob.endswith("/")
+			glob = glob.rstrip("/")
+			anchored = "/" in glob
+			pattern = "(?:%s)\\Z" % (self.translate_glob(glob.lstrip("/")))
+			if anchored:
+				path_folder.append(pattern)
+				if not dir_only:
+					path_file.append(pattern)
+			else:
+				name_folder.append(pattern)
+				if not dir_only:
+					name_file.append(pattern)
+		self.name_folder = self.combine(name_folder)
+		self.name_file = self.combine(name_file)
+		self.path_folder = self.combine(path_folder)
+		self.path_file = self.combine(path_file)
+
+	@staticmethod
+	def from_settings(get_settings, globs=None):
+		return FilterEngine(
+			get_settings("exclude_folder_patterns"),
+			get_settings("exclude_file_patterns"),
+			(get_settings("exclude_globs") or []) + (globs or [])
+		)
+
+	@staticmethod
+	def combine(patterns):
+		if len(patterns) == 0:
+			return None
+		return re.compile("|".join(patterns))
+
+	@staticmethod
+	def translate_glob(glob):
+		index = 0
+		pattern = ""
+		while index < len(glob):
+			if glob.startswith("**/", index):
+				pattern += "(?:.*/)?"
+				index += 3
+			elif glob.startswith("/**", index) and index + 3 == len(glob):
+				pattern += "(?:/.*)?"
+				index += 3
+			elif glob.startswith("**", index):
+				pattern += ".*"
+				index += 2
+			elif glob[index] == "*":
+				pattern += "[^/]*"
+				index += 1
+			elif glob[index] == "?":
+				pattern += "[^/]"
+				index += 1
+			elif glob[index] == "[" and "]" in glob[index+2:]:
+				end = glob.index("]", index+2)
+				char_class = glob[index+1:end].replace("\\", "\\\\")
+				if char_class.startswith("!"):
+					char_class = "^" + char_class[1:]
+				pattern += "[%s]" % (char_class)
+				index = end + 1
+			else:
+				pattern += re.escape(glob[index])
+				index += 1
+		return pattern
+
+	@staticmethod
+	def normalize(path):
+		return path.replace("\\", "/").strip("/")
+
+	def match(self, path, is_dir=False):
+		path = self.normalize(path)
+		name = path.rsplit("/", 1)[-1]
+		if is_dir:
+			name_pattern, path_pattern = self.name_folder, self.path_folder
+		else:
+			name_pattern, path_pattern = self.name_file, self.path_file
+		if name_pattern is not None and name_pattern.match(name) is not None:
+			return True
+		return path_pattern is not None and path_pattern.match(path) is not None
+
+	def is_excluded(self, path):
+		path = self.normalize(path)
+		if self.match(path):
+			return True
+		parts = path.split("/")
+		for index in range(2, len(parts)):
+			if self.match("/".join(parts[:index]), True):
+				return True
+		return False
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sublime
+from .drsync_state import *
+
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = "DrSync.drsync-manifest"
+HASH_BLOCK_SIZE = 65536
+
+
+class SyncManifest():
+	def __init__(self, entries=None):
+		self.entries = entries or {}
+
+	@staticmethod
+	def local_path():
+		return os.path.join(sublime.packages_path(), "User", "DrSync", MANIFEST_FILENAME)
+
+	@staticmethod
+	def relative_path(parent, filepath):
+		path = os.path.join(os.path.basename(parent), os.path.relpath(filepath, parent))
+		return path.replace(os.path.sep, "/")
+
+	@staticmethod
+	def hash_file(filepath):
+		md5 = hashlib.md5()
+		f = open(filepath, "rb")
+		try:
+			while True:
+				block = f.read(HASH_BLOCK_SIZE)
+				if not block:
+					break
+				md5.update(block)
+		finally:
+			f.close()
+		return md5.hexdigest()
+
+	@staticmethod
+	def from_files(file_list, previous=None):
+		entries = {}
+		for record in file_list:
+			parent, filepath = record[:2]
+			path = SyncManifest.relative_path(parent, filepath)
+			if len(record) > 3:
+				size, mtime = record[2], record[3]
+			else:
+				stat = os.stat(filepath)
+				size, mtime = stat.st_size, stat.st_mtime
+			entry = None
+			if previous is not None:
+				entry = previous.entries.get(path)
+			if entry is None or entry["size"] != size or entry["mtime"] != mtime or entry.get("hash") is None:
+				entries[path] = {"size": size, "mtime": mtime, "hash": SyncManifest.hash_file(filepath)}
+			else:
+				entries[path] = {"size": size, "mtime": mtime, "hash": entry["hash"]}
+				for key in ["id", "rev", "synced"]:
+					if key in entry:
+						entries[path][key] = entry[key]
+		return SyncManifest(entries)
+
+	def matches(self, path, filepath, remote):
+		try:
+			stat = os.stat(filepath)
+		except OSError:
+			return False
+		if stat.st_size != remote["size"]:
+			return False
+		entry = self.entries.get(path)
+		fresh = entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+		if remote.get("hash") is not None:
+			if not fresh or entry.get("hash") is None:
+				entry = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": self.hash_file(filepath)}
+				self.entries[path] = entry
+			return entry["hash"] == remote["hash"]
+		if remote.get("rev") is not None:
+			return fresh and entry.get("rev") == remote["rev"]
+		return False
+
+	def record(self, path, filepath, remote, file_hash=None):
+		stat = os.stat(filepath)
+		entry = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash or remote.get("hash")}
+		for key in ["id", "rev"]:
+			if remote.get(key) is not None:
+				entry[key] = remote[key]
+		self.entries[path] = entry
+
+	@staticmethod
+	def layout_of(entry):
+		if "chunks" in entry:
+			return "chunks"
+		if entry.get("bundle"):
+			return "bundle"
+		return "files"
+
+	def mark_bundled(self):
+		for entry in self.entries.values():
+			entry["bundle"] = True
+
+	def diff(self, remote, layout="files"):
+		changed = []
+		for path, entry in self.entries.items():
+			remote_entry = remote.entries.get(path)
+			if remote_entry is None or remote_entry["size"] != entry["size"] or remote_entry["hash"] != entry["hash"] or self.layout_of(remote_entry) != layout:
+				changed.append(path)
+			elif layout == "chunks":
+				entry["chunks"] = remote_entry["chunks"]
+		removed = [path for path in remote.entries if path not in self.entries]
+		return sorted(changed), sorted(removed)
+
+	def select(self, roots, layout=None):
+		file_list = []
+		for path in sorted(self.entries.keys()):
+			entry = self.entries[path]
+			if layout is not None and self.layout_of(entry) != layout:
+				continue
+			root, name = (path.split("/", 1) + [""])[:2]
+			if root not in roots or (roots[root][1] is not None and name not in roots[root][1]):
+				continue
+			file_list.append([roots[root][0], path, entry])
+		return file_list
+
+	def encode(self):
+		return sublime.encode_value({"version": MANIFEST_VERSION, "entries": self.entries})
+
+	@staticmethod
+	def decode(data):
+		try:
+			manifest = sublime.decode_value(data)
+		except Exception:
+			return SyncManifest()
+		if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+			return SyncManifest()
+		return SyncManifest(manifest.get("entries"))
+
+	@staticmethod
+	def load(filepath):
+		if not os.path.exists(filepath):
+			return SyncManifest()
+		f = open(filepath, "r")
+		try:
+			return SyncManifest.decode(f.read())
+		finally:
+			f.close()
+
+	def save(self, filepath):
+		parent = os.path.dirname(filepath)
+		if not os.path.exists(parent):
+			os.makedirs(parent)
+		out = open(filepath, "w")
+		out.write(self.encode())
+		out.close()
+
+	@staticmethod
+	def load_local():
+		state = SyncState.open()
+		if state is not None:
+			try:
+				entries = state.load_files()
+			finally:
+				state.close()
+			if len(entries) > 0:
+				return SyncManifest(entries)
+		return SyncManifest.load(SyncManifest.local_path())
+
+	def save_local(self):
+		state = SyncState.open()
+		if state is None:
+			self.save(SyncManifest.local_path())
+			return
+		try:
+			state.save_files(self.entries)
+		finally:
+			state.close()
+		if os.path.exists(SyncManifest.local_path()):
+			os.remove(SyncManifest.local_path())
@@ -0,0 +1,244 @@
+import socket
+import threading
+import time
+from socket import timeout as SocketTimeout
+from .urllib3 import *
+from .urllib3._collections import RecentlyUsedContainer
+from .urllib3.connection import VerifiedHTTPSConnection
+from .urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from .urllib3.exceptions import ConnectTimeoutError
+from .urllib3.packages.ssl_match_hostname import match_hostname
+from .urllib3.poolmanager import SSL_KEYWORDS
+from .urllib3.util import parse_url
+
+
+def create_ssl_context(ca_certs=None, ssl_version=None):
+	try:
+		import ssl
+	except (ImportError):
+		return None
+	context = ssl.SSLContext(ssl_version or ssl.PROTOCOL_SSLv23)
+	context.options |= getattr(ssl, "OP_NO_SSLv2", 0) | getattr(ssl, "OP_NO_SSLv3", 0)
+	# Disable TLS compression to mitigate CRIME attack
+	context.options |= getattr(ssl, "OP_NO_COMPRESSION", 0x20000)
+	if not ca_certs:
+		raise ValueError("no CA certificate bundle found, refusing to connect without certificate verification")
+	context.verify_mode = ssl.CERT_REQUIRED
+	context.load_verify_locations(ca_certs)
+	return context
+
+
+class SSLContextCache():
+	def __init__(self, resolve_cert_file, ssl_version=None):
+		self.resolve_cert_file = resolve_cert_file
+		self.ssl_version = ssl_version
+		self.lock = threading.Lock()
+		self.cert_file = None
+		self.ssl_context = None
+
+	def invalidate(self):
+		with self.lock:
+			self.cert_file = None
+			self.ssl_context = None
+
+	def get_cert_file(self):
+		with self.lock:
+			if not self.cert_file:
+				self.cert_file = self.resolve_cert_file()
+				self.ssl_context = None
+			return self.cert_file
+
+	def get_ssl_context(self):
+		cert_file = self.get_cert_file()
+		with self.lock:
+			if self.ssl_context is None:
+				self.ssl_context = create_ssl_context(cert_file, self.ssl_version)
+			return self.ssl_context
+
+
+class ContextHTTPSConnection(VerifiedHTTPSConnection):
+	ssl_context = None
+
+	def connect(self):
+		if self.ssl_context is None:
+			return VerifiedHTTPSConnection.connect(self)
+		import ssl
+		try:
+			sock = socket.create_connection(
+				address=(self.host, self.port), timeout=self.timeout,
+				**self.conn_kw)
+		except SocketTimeout:
+			raise ConnectTimeoutError(
+				self, "Connection to %s timed out. (connect timeout=%s)" %
+				(self.host, self.timeout))
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, self.tcp_nodelay)
+		if getattr(self, "_tunnel_host", None):
+			self.sock = sock
+			self._tunnel()
+		if getattr(ssl, "HAS_SNI", False):
+			self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+		else:
+			self.sock = self.ssl_context.wrap_socket(sock)
+		if self.ssl_context.verify_mode != ssl.CERT_NONE and not getattr(self.ssl_context, "check_hostname", False):
+			match_hostname(self.sock.getpeercert(), self.host)
+
+
+class ContextHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = ContextHTTPSConnection
+
+	def __init__(self, host, port=None, ssl_context=None, **kw):
+		HTTPSConnectionPool.__init__(self, host, port, **kw)
+		self.ssl_context = ssl_context
+
+	def _prepare_conn(self, conn):
+		conn.ssl_context = self.ssl_context
+		return HTTPSConnectionPool._prepare_conn(self, conn)
+
+
+class ContextPoolManager(PoolManager):
+	def _new_pool(self, scheme, host, port):
+		kwargs = self.connection_pool_kw.copy()
+		if scheme == "https":
+			return ContextHTTPSConnectionPool(host, port, **kwargs)
+		kwargs.pop("ssl_context", None)
+		for kw in SSL_KEYWORDS:
+			kwargs.pop(kw, None)
+		return HTTPConnectionPool(host, port, **kwargs)
+
+
+class SharedPoolManager():
+	def __init__(self, num_pools=4, maxsize=8, idle_timeout=60.0, **connection_pool_kw):
+		self.num_pools = num_pools
+		self.maxsize = maxsize
+		self.idle_timeout = idle_timeout
+		self.connection_pool_kw = connection_pool_kw
+		self.lock = threading.RLock()
+		self.pool_manager = None
+		self.last_used = {}
+		self.in_flight = {}
+		self.requests = 0
+		self.retired_connections = 0
+
+	def configure(self, num_pools=None, maxsize=None, idle_timeout=None, **connection_pool_kw):
+		with self.lock:
+			changed = False
+			if num_pools is not None and num_pools != self.num_pools:
+				self.num_pools = num_pools
+				changed = True
+			if maxsize is not None and maxsize != self.maxsize:
+				self.maxsize = maxsize
+				changed = True
+			if idle_timeout is not None:
+				self.idle_timeout = idle_timeout
+			for key, value in connection_pool_kw.items():
+				if key not in self.connection_pool_kw or self.connection_pool_kw[key] != value:
+					self.connection_pool_kw[key] = value
+					changed = True
+			if changed:
+				self.clear()
+
+	def dispose_pool(self, pool):
+		self.retired_connections += pool.num_connections
+		pool.close()
+
+	def get_pool_manager(self):
+		if self.pool_manager is None:
+			self.pool_manager = ContextPoolManager(
+				num_pools=self.num_pools,
+				maxsize=self.maxsize,
+				block=False,
+				**self.connection_pool_kw
+			)
+			self.pool_manager.pools = RecentlyUsedContainer(self.num_pools, dispose_func=self.dispose_pool)
+		return self.pool_manager
+
+	def reap(self, now=None):
+		with self.lock:
+			if self.pool_manager is None or self.idle_timeout is None:
+				return
+			now = now or time.time()
+			for pool_key, last_used in list(self.last_used.items()):
+				if self.in_flight.get(pool_key, 0) > 0 or now - last_used < self.idle_timeout:
+					continue
+				if pool_key in self.pool_manager.pools:
+					del self.pool_manager.pools[pool_key]
+				del self.last_used[pool_key]
+
+	def clear(self):
+		with self.lock:
+			if self.pool_manager is not None:
+				self.pool_manager.clear()
+			self.pool_manager = None
+			self.last_used = {}
+
+	def urlopen(self, method, url, **kw):
+		u = parse_url(url)
+		scheme = u.scheme or "http"
+		with self.lock:
+			self.reap()
+			pool_manager = self.get_pool_manager()
+			pool = pool_manager.connection_from_host(u.host, port=u.port, scheme=scheme)
+			pool_key = (scheme, pool.host, pool.port)
+			self.in_flight[pool_key] = self.in_flight.get(pool_key, 0) + 1
+			self.requests += 1
+		try:
+			response = pool_manager.urlopen(method, url, **kw)
+		except Exception as e:
+			self.finish(pool_key)
+			raise e
+		if getattr(response, "_connection", None) is None:
+			self.finish(pool_key)
+		else:
+			self.track_release(response, pool_key)
+		return response
+
+	def finish(self, pool_key):
+		with self.lock:
+			self.in_flight[pool_key] -= 1
+			self.last_used[pool_key] = time.time()
+
+	def track_release(self, response, pool_key):
+		release_conn = response.release_conn
+		close = response.close
+		finished = []
+
+		def finish():
+			if len(finished) == 0:
+				finished.append(True)
+				self.finish(pool_key)
+
+		def tracked_release_conn():
+			try:
+				release_conn()
+			finally:
+				finish()
+
+		def tracked_close():
+			try:
+				close()
+			finally:
+				finish()
+
+		response.release_conn = tracked_release_conn
+		response.close = tracked_close
+
+	def statistics(self):
+		with self.lock:
+			connections = self.retired_connections
+			idle = 0
+			if self.pool_manager is not None:
+				for pool_key in self.pool_manager.pools.keys():
+					pool = self.pool_manager.pools.get(pool_key)
+					if pool is None:
+						continue
+					connections += pool.num_connections
+					if pool.pool is not None:
+						idle += len([conn for conn in pool.pool.queue if conn is not None])
+			reused = max(self.requests - connections, 0)
+			return {
+				"requests": self.requests,
+				"connections": connections,
+				"reused": reused,
+				"idle": idle,
+				"hit_rate": reused * 100.0 / self.requests if self.requests > 0 else 0.0
+			}
@@ -0,0 +1,110 @@
+import calendar
+import random
+import threading
+import time
+from email.utils import parsedate
+from .drsync_concurrency import *
+
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RATE_LIMIT_STATUS = [429, 503]
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+
+class RetryPolicy():
+	def __init__(self, max_retries=5, budget=100, base_delay=1.0, max_delay=32.0, on_retry=None):
+		self.max_retries = max(0, max_retries)
+		self.budget = max(0, budget)
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.on_retry = on_retry
+		self.lock = threading.Lock()
+		self.retries = 0
+		self.waiting = 0
+
+	@staticmethod
+	def from_settings(settings):
+		settings = settings or {}
+		return RetryPolicy(
+			max_retries=settings.get("request_retries", 5),
+			budget=settings.get("retry_budget", 100),
+			max_delay=settings.get("max_backoff", 32.0)
+		)
+
+	@staticmethod
+	def error_reasons(error):
+		body = getattr(error, "body", None)
+		if not isinstance(body, dict) or not isinstance(body.get("error"), dict):
+			return []
+		return [item.get("reason") for item in body["error"].get("errors", []) if isinstance(item, dict)]
+
+	@staticmethod
+	def is_exhausted(error):
+		return getattr(error, "retry_exhausted", False)
+
+	def is_rate_limited(self, error):
+		status = getattr(error, "status", None)
+		if status in RATE_LIMIT_STATUS:
+			return True
+		return status == 403 and len(set(self.error_reasons(error)) & set(RATE_LIMIT_REASONS)) > 0
+
+	def is_retryable(self, error):
+		status = getattr(error, "status", None)
+		if status in RETRY_STATUS or (status is not None and status >= 500):
+			return True
+		return self.is_rate_limited(error)
+
+	def retry_after(self, error):
+		headers = getattr(error, "headers", None) or {}
+		value = headers.get("Retry-After")
+		if value is None:
+			return None
+		try:
+			return max(0.0, float(value))
+		except ValueError:
+			date = parsedate(value)
+			if date is None:
+				return None
+			return max(0.0, calendar.timegm(date) - time.time())
+
+	def backoff(self, attempt):
+		return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+	def next_delay(self, error, attempt):
+		if attempt >= self.max_retries or not self.is_retryable(error):
+			return None
+		with self.lock:
+			if self.retries >= self.budget:
+				return None
+			self.retries += 1
+		delay = self.retry_after(error)
+		if delay is None:
+			return self.backoff(attempt)
+		return min(self.max_delay, delay)
+
+	def wait(self, error, attempt):
+		if self.is_rate_limited(error):
+			TRANSFER_CONCURRENCY.decrease()
+		delay = self.next_delay(error, attempt)
+		if delay is None:
+			error.retry_exhausted = True
+			return False
+		with self.lock:
+			self.waiting += 1
+		if self.on_retry is not None:
+			self.on_retry(self, delay, error)
+		try:
+			time.sleep(delay)
+		finally:
+			with self.lock:
+				self.waiting -= 1
+		return True
+
+	def describe(self):
+		with self.lock:
+			if self.retries == 0:
+				return ""
+			description = "%d/%d retries" % (self.retries, self.budget)
+			if self.waiting > 0:
+				description += ", %d waiting" % (self.waiting)
+		return description
@@ -0,0 +1,51 @@
+import os
+import stat
+from .drsync_filter import *
+
+
+class LocalScanner():
+	def __init__(self, filter_engine=None):
+		self.filter_engine = filter_engine or FilterEngine()
+
+	def list_dir(self, dir_path):
+		if hasattr(os, "scandir"):
+			for entry in os.scandir(dir_path):
+				try:
+					if entry.is_dir():
+						yield entry.name, entry.path, True, None
+					elif entry.is_file():
+						yield entry.name, entry.path, False, entry.stat()
+				except OSError:
+					continue
+		else:
+			for name in os.listdir(dir_path):
+				pathname = os.path.join(dir_path, name)
+				try:
+					st = os.stat(pathname)
+				except OSError:
+					continue
+				if stat.S_ISDIR(st.st_mode):
+					yield name, pathname, True, None
+				elif stat.S_ISREG(st.st_mode):
+					yield name, pathname, False, st
+
+	def scan(self, dir_path, subdir=True, folder_filter=None, file_filter=None, base_path=None, relative_path=None):
+		base_path = base_path or dir_path
+		relative_path = relative_path or os.path.basename(dir_path)
+		for name, pathname, is_dir, st in self.list_dir(dir_path):
+			path = relative_path + "/" + name
+			if is_dir:
+				if subdir and not self.filter_engine.match(path, True) and (folder_filter is None or folder_filter(name)):
+					for record in self.scan(pathname, subdir, folder_filter, file_filter, base_path, path):
+						yield record
+			elif not self.filter_engine.match(path) and (file_filter is None or file_filter(name)):
+				yield [base_path, pathname, st.st_size, st.st_mtime]
+
+	def stat_file(self, base_path, pathname):
+		try:
+			st = os.stat(pathname)
+		except OSError:
+			return None
+		if not stat.S_ISREG(st.st_mode):
+			return None
+		return [base_path, pathname, st.st_size, st.st_mtime]
@@ -0,0 +1,97 @@
+import os
+import sublime
+import threading
+import time
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+
+STATE_VERSION = 1
+STATE_FILENAME = "DrSync.drsync-state"
+STATE_SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT, remote_id TEXT, rev TEXT, synced REAL)",
+	"CREATE TABLE IF NOT EXISTS folders (key TEXT PRIMARY KEY, folder_id TEXT)"
+]
+
+
+class SyncState():
+	LOCK = threading.Lock()
+
+	def __init__(self, filepath=None):
+		self.filepath = filepath or SyncState.local_path()
+		parent = os.path.dirname(self.filepath)
+		if not os.path.exists(parent):
+			os.makedirs(parent)
+		self.connection = sqlite3.connect(self.filepath)
+		version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+		if version != STATE_VERSION:
+			with self.connection:
+				self.connection.execute("DROP TABLE IF EXISTS files")
+				self.connection.execute("DROP TABLE IF EXISTS folders")
+				for statement in STATE_SCHEMA:
+					self.connection.execute(statement)
+				self.connection.execute("PRAGMA user_version = %d" % (STATE_VERSION))
+
+	@staticmethod
+	def available():
+		return sqlite3 is not None
+
+	@staticmethod
+	def local_path():
+		return os.path.join(sublime.packages_path(), "User", "DrSync", STATE_FILENAME)
+
+	@staticmethod
+	def open(filepath=None):
+		if not SyncState.available():
+			return None
+		try:
+			return SyncState(filepath)
+		except Exception:
+			return None
+
+	def close(self):
+		self.connection.close()
+
+	def load_files(self):
+		entries = {}
+		for path, size, mtime, file_hash, remote_id, rev, synced in self.connection.execute("SELECT path, size, mtime, hash, remote_id, rev, synced FROM files"):
+			entry = {"size": size, "mtime": mtime, "hash": file_hash}
+			if remote_id is not None:
+				entry["id"] = remote_id
+			if rev is not None:
+				entry["rev"] = rev
+			if synced is not None:
+				entry["synced"] = synced
+			entries[path] = entry
+		return entries
+
+	def save_files(self, entries, synced=None):
+		synced = synced or time.time()
+		with SyncState.LOCK:
+			existing = {}
+			for row in self.connection.execute("SELECT path, size, mtime, hash, remote_id, rev, synced FROM files"):
+				existing[row[0]] = row
+			rows = []
+			for path, entry in entries.items():
+				row = (path, entry["size"], entry["mtime"], entry.get("hash"), entry.get("id"), entry.get("rev"), entry.get("synced", synced))
+				if existing.get(path) != row:
+					rows.append(row)
+			removed = [(path,) for path in existing if path not in entries]
+			with self.connection:
+				self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+				self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime, hash, remote_id, rev, synced) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+	def load_folders(self):
+		return dict(self.connection.execute("SELECT key, folder_id FROM folders").fetchall())
+
+	def save_folders(self, entries):
+		with SyncState.LOCK:
+			existing = self.load_folders()
+			rows = [(key, folder_id) for key, folder_id in entries.items() if existing.get(key) != folder_id]
+			removed = [(key,) for key in existing if key not in entries]
+			with self.connection:
+				self.connection.executemany("DELETE FROM folders WHERE key = ?", removed)
+				self.connection.executemany("INSERT OR REPLACE INTO folders (key, folder_id) VALUES (?, ?)", rows)
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+
+THROTTLE_BLOCK_SIZE = 16384
+THROTTLE_MAX_SLEEP = 0.5
+
+
+class TokenBucket():
+	def __init__(self, rate=0):
+		self.lock = threading.Lock()
+		self.rate = 0
+		self.capacity = 0
+		self.tokens = 0
+		self.updated = time.time()
+		self.configure(rate)
+
+	def configure(self, rate):
+		with self.lock:
+			self.rate = max(0, rate or 0)
+			self.capacity = max(self.rate, THROTTLE_BLOCK_SIZE)
+			self.tokens = min(self.tokens, self.capacity)
+			self.updated = time.time()
+
+	def is_limited(self):
+		return self.rate > 0
+
+	def consume(self, amount):
+		while amount > 0:
+			with self.lock:
+				if self.rate <= 0:
+					return
+				now = time.time()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				take = min(amount, self.capacity)
+				if self.tokens >= take:
+					self.tokens -= take
+					amount -= take
+					continue
+				delay = (take - self.tokens) / self.rate
+			time.sleep(min(delay, THROTTLE_MAX_SLEEP))
+
+	def wrap_body(self, body, headers):
+		if body is None or not self.is_limited():
+			return body
+		if isinstance(body, str):
+			body = body.encode("utf-8")
+		if isinstance(body, bytes):
+			length = len(body)
+		elif hasattr(body, "fileno"):
+			length = os.fstat(body.fileno()).st_size - body.tell()
+		else:
+			length = len(body)
+		if "content-length" not in [key.lower() for key in headers]:
+			headers["Content-Length"] = length
+		return ThrottledBody(body, self)
+
+	def wrap_response(self, response):
+		return ThrottledResponse(response, self)
+
+
+class ThrottledBody():
+	def __init__(self, body, bucket):
+		self.body = body
+		self.bucket = bucket
+
+	def blocks(self):
+		if isinstance(self.body, bytes):
+			yield self.body
+		elif hasattr(self.body, "read"):
+			while True:
+				block = self.body.read(THROTTLE_BLOCK_SIZE)
+				if not block:
+					return
+				yield block
+		else:
+			for block in self.body:
+				yield block
+
+	def __iter__(self):
+		for block in self.blocks():
+			for offset in range(0, len(block), THROTTLE_BLOCK_SIZE):
+				data = block[offset:offset+THROTTLE_BLOCK_SIZE]
+				self.bucket.consume(len(data))
+				yield data
+
+
+class ThrottledResponse():
+	def __init__(self, response, bucket):
+		self.response = response
+		self.bucket = bucket
+
+	def stream(self, amt=2**16, decode_content=None):
+		for block in self.response.stream(amt, decode_content=decode_content):
+			self.bucket.consume(len(block))
+			yield block
+
+	def read(self, amt=None, decode_content=None, cache_content=False):
+		data = self.response.read(amt, decode_content=decode_content, cache_content=cache_content)
+		if data:
+			self.bucket.consume(len(data))
+		return data
+
+	def __getattr__(self, name):
+		return getattr(self.response, name)
+
+
+UPLOAD_BUCKET = TokenBucket()
+DOWNLOAD_BUCKET = TokenBucket()
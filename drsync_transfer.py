@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import queue
+from .drsync_concurrency import *
+from .drsync_retry import *
+
+
+class TransferError(Exception):
+	def __init__(self, name, exception):
+		Exception.__init__(self, str(exception))
+		self.name = name
+		self.exception = exception
+
+
+class TransferEngine():
+	def __init__(self, workers=4, retries=2, retry_delay=1.0, on_progress=None, retry_policy=None, controller=None):
+		self.workers = max(1, workers)
+		self.retries = max(0, retries)
+		self.retry_delay = retry_delay
+		self.on_progress = on_progress
+		self.retry_policy = retry_policy
+		self.controller = controller
+		self.lock = threading.Lock()
+		self.total = 0
+		self.completed = 0
+		self.total_bytes = 0
+		self.transferred_bytes = 0
+
+	@staticmethod
+	def from_settings(settings, on_progress=None, retry_policy=None):
+		settings = settings or {}
+		workers = settings.get("concurrency", 4)
+		controller = None
+		if settings.get("adaptive_concurrency", True):
+			controller = TRANSFER_CONCURRENCY
+			controller.configure(workers, settings.get("max_concurrency", 16))
+			workers = controller.maximum
+		return TransferEngine(
+			workers=workers,
+			retries=settings.get("retries", 2),
+			on_progress=on_progress,
+			retry_policy=retry_policy,
+			controller=controller
+		)
+
+	@staticmethod
+	def folder_levels(paths):
+		folders = set()
+		for path in paths:
+			parent = os.path.dirname(path.replace("\\", "/"))
+			while parent != "" and parent != "/":
+				folders.add(parent)
+				parent = os.path.dirname(parent)
+		levels = {}
+		for folder in folders:
+			levels.setdefault(folder.count("/"), []).append(folder)
+		return [sorted(levels[depth]) for depth in sorted(levels)]
+
+	@staticmethod
+	def format_size(size):
+		for unit in ["B", "KB", "MB"]:
+			if size < 1024:
+				return "%.1f %s" % (size, unit) if unit != "B" else "%d %s" % (size, unit)
+			size /= 1024.0
+		return "%.1f GB" % (size)
+
+	def add_total(self, count, size=0):
+		with self.lock:
+			self.total += count
+			self.total_bytes += size
+
+	def add_transferred(self, size, name=None):
+		with self.lock:
+			self.transferred_bytes += size
+		if self.on_progress is not None:
+			self.on_progress(self, name)
+
+	def report(self, name, size=0):
+		with self.lock:
+			self.completed += 1
+			self.transferred_bytes += size
+		if self.on_progress is not None:
+			self.on_progress(self, name)
+
+	def percentage(self):
+		with self.lock:
+			if self.total_bytes > 0:
+				return min(int(self.transferred_bytes*100/self.total_bytes), 100)
+			if self.total > 0:
+				return min(int(self.completed*100/self.total), 100)
+		return 0
+
+	def describe(self):
+		with self.lock:
+			description = "%d/%d files" % (self.completed, self.total)
+			if self.total_bytes > 0:
+				description += ", %s/%s" % (self.format_size(self.transferred_bytes), self.format_size(self.total_bytes))
+		if self.controller is not None:
+			description += ", " + self.controller.describe()
+		if self.retry_policy is not None and self.retry_policy.describe() != "":
+			description += ", " + self.retry_policy.describe()
+		return description
+
+	def attempt(self, handler, item):
+		attempt = 0
+		while True:
+			try:
+				return handler(item)
+			except Exception as e:
+				if attempt >= self.retries or RetryPolicy.is_exhausted(e):
+					raise e
+				attempt += 1
+				time.sleep(self.retry_delay * attempt)
+
+	def run_folders(self, paths, handler):
+		for level in self.folder_levels(paths):
+			self.run(level, handler, counted=False)
+
+	def run(self, items, handler, name_fx=None, size_fx=None, counted=True, weight_fx=None):
+		if len(items) == 0:
+			return
+		tasks = queue.Queue()
+		for item in items:
+			tasks.put(item)
+		failures = []
+		abort = threading.Event()
+
+		def worker():
+			while not abort.is_set():
+				if self.controller is not None:
+					self.controller.acquire()
+				try:
+					try:
+						item = tasks.get(block=False)
+					except queue.Empty:
+						return
+					name = name_fx(item) if name_fx is not None else str(item)
+					start = time.time()
+					try:
+						self.attempt(handler, item)
+					except Exception as e:
+						with self.lock:
+							failures.append(TransferError(name, e))
+						abort.set()
+						return
+					if self.controller is not None:
+						self.controller.success(time.time() - start, weight_fx(item) if weight_fx is not None else 0)
+				finally:
+					if self.controller is not None:
+						self.controller.release()
+				if counted:
+					self.report(name, size_fx(item) if size_fx is not None else 0)
+
+		threads = []
+		for i in range(min(self.workers, len(items))):
+			thread = threading.Thread(target=worker)
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+		if len(failures) > 0:
+			raise failures[0]
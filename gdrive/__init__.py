@@ -1,3 +1,6 @@
 from .gdrive_auth import *
+from .gdrive_batch import *
+from .gdrive_cache import *
 from .gdrive_client import *
+from .gdrive_snapshot import *
 from .gdrive_util import *
@@ -0,0 +1,159 @@
+import re
+import json
+import sublime
+import uuid
+import urllib.parse
+from .gdrive_connection import *
+
+BATCH_URL = "https://www.googleapis.com/batch/drive/v2"
+BATCH_LIMIT = 100
+BATCH_MAX_ROUNDS = 6
+BOUNDARY_PATTERN = re.compile(r"boundary=\"?([^\";]+)\"?")
+CONTENT_ID_PATTERN = re.compile(r"item-(\d+)")
+SEPARATOR_PATTERN = re.compile(b"\r?\n\r?\n")
+
+
+class BatchResult():
+	def __init__(self, status, reason, headers, body):
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.body = body
+
+	def ok(self):
+		return 200 <= self.status < 300
+
+	def __str__(self):
+		return "[%d] %s" % (self.status, self.reason)
+
+
+class BatchError(Exception):
+	def __init__(self, target, result):
+		Exception.__init__(self, "%s %s" % (target, result))
+		self.status = result.status
+		self.result = result
+
+
+class GDriveBatch():
+	def __init__(self, client):
+		self.client = client
+		self.requests = []
+
+	def add(self, method, target, params=None, body=None):
+		self.requests.append((method, target, params, body))
+		return len(self.requests) - 1
+
+	def delete(self, file_id):
+		return self.add("DELETE", "/files/"+file_id)
+
+	def get_metadata(self, file_id, fields=None):
+		params = {}
+		if fields is not None:
+			params["fields"] = fields
+		return self.add("GET", "/files/"+file_id, params)
+
+	def lookup(self, query, fields, max_results=None):
+		params = {"q": query, "fields": "items(%s)" % (fields)}
+		if max_results is not None:
+			params["maxResults"] = max_results
+		return self.add("GET", "/files", params)
+
+	def encode_part(self, index, request):
+		method, target, params, body = request
+		url, params, headers = self.client.request(target, dict(params or {}), method="GET")
+		url = urllib.parse.urlsplit(url)
+		lines = [
+			"Content-Type: application/http",
+			"Content-ID: <item-%d>" % (index),
+			"",
+			"%s %s?%s HTTP/1.1" % (method, url.path, url.query)
+		]
+		for key, value in headers.items():
+			lines.append("%s: %s" % (key, value))
+		if body is not None:
+			body = sublime.encode_value(body)
+			lines.append("Content-Type: application/json; charset=UTF-8")
+			lines.append("Content-Length: %d" % (len(body.encode("utf-8"))))
+			lines.append("")
+			lines.append(body)
+		else:
+			lines.append("")
+		return "\r\n".join(lines) + "\r\n"
+
+	def encode(self, indexes, boundary):
+		parts = []
+		for index in indexes:
+			parts.append("--%s\r\n%s" % (boundary, self.encode_part(index, self.requests[index])))
+		parts.append("--%s--\r\n" % (boundary))
+		return "".join(parts).encode("utf-8")
+
+	@staticmethod
+	def parse_headers(data):
+		headers = {}
+		for line in data.decode("utf-8", "replace").splitlines():
+			if ":" in line:
+				key, value = line.split(":", 1)
+				headers[key.strip().title()] = value.strip()
+		return headers
+
+	@staticmethod
+	def decode(content_type, data):
+		match = BOUNDARY_PATTERN.search(content_type or "")
+		if match is None:
+			raise ValueError("batch response has no boundary")
+		results = {}
+		for part in data.split(("--" + match.group(1)).encode("utf-8")):
+			part = part.strip(b"\r\n")
+			if part == b"" or part == b"--":
+				continue
+			sections = SEPARATOR_PATTERN.split(part, 2)
+			if len(sections) < 2:
+				continue
+			outer_headers = GDriveBatch.parse_headers(sections[0])
+			content_id = CONTENT_ID_PATTERN.search(outer_headers.get("Content-Id", ""))
+			if content_id is None:
+				continue
+			lines = sections[1].decode("utf-8", "replace").splitlines()
+			status_line = lines[0].split(" ", 2)
+			headers = GDriveBatch.parse_headers(sections[1])
+			body = None
+			if len(sections) > 2 and sections[2].strip() != b"":
+				try:
+					body = json.loads(sections[2].decode("utf-8"))
+				except ValueError:
+					body = sections[2]
+			status = int(status_line[1])
+			results[int(content_id.group(1))] = BatchResult(status, status_line[2] if len(status_line) > 2 else "", headers, body)
+		return results
+
+	def send(self, indexes):
+		boundary = "drsync_batch_" + uuid.uuid4().hex
+		body = self.encode(indexes, boundary)
+		headers = {"Content-Type": "multipart/mixed; boundary=" + boundary, "Content-Length": len(body)}
+		response = self.client.connection.request("POST", BATCH_URL, body=body, headers=headers, raw_response=True)
+		data = response["data"].read()
+		response["data"].release_conn()
+		return self.decode(response["headers"].get("Content-Type"), data)
+
+	def execute(self):
+		results = [None] * len(self.requests)
+		pending = list(range(len(self.requests)))
+		attempt = 0
+		while len(pending) > 0:
+			retry = []
+			for offset in range(0, len(pending), BATCH_LIMIT):
+				indexes = pending[offset:offset+BATCH_LIMIT]
+				responses = self.send(indexes)
+				for index in indexes:
+					result = responses.get(index)
+					if result is None:
+						result = BatchResult(500, "Missing batch response", {}, None)
+					results[index] = result
+					if not result.ok() and self.client.connection.retry_policy.is_retryable(result):
+						retry.append(index)
+			if len(retry) == 0 or attempt >= BATCH_MAX_ROUNDS or not self.client.connection.retry_policy.wait(results[retry[0]], attempt):
+				break
+			pending = retry
+			attempt += 1
+		self.requests = []
+		return results
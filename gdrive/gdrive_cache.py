@@ -0,0 +1,202 @@
+import os
+import sublime
+import threading
+from ..drsync_state import *
+
+
+FOLDER_CACHE_VERSION = 1
+FOLDER_CACHE_FILENAME = "gdrive.drsync-folders"
+UPLOAD_SESSIONS_FILENAME = "gdrive.drsync-uploads"
+
+
+class GDriveFolderCache():
+	def __init__(self, entries=None):
+		self.lock = threading.Lock()
+		self.entries = {}
+		self.verified = set()
+		if entries:
+			self.entries.update(entries)
+
+	@staticmethod
+	def local_path():
+		return os.path.join(sublime.packages_path(), "User", "DrSync", FOLDER_CACHE_FILENAME)
+
+	@staticmethod
+	def build_key(full_path, parent_id="appdata"):
+		return "/".join([parent_id] + list(full_path))
+
+	def get(self, key):
+		with self.lock:
+			if key not in self.entries:
+				return None, False
+			return self.entries[key], key in self.verified
+
+	def set(self, key, folder_id):
+		with self.lock:
+			self.entries[key] = folder_id
+			self.verified.add(key)
+
+	def unverified(self):
+		with self.lock:
+			return [(key, folder_id) for key, folder_id in self.entries.items() if key not in self.verified]
+
+	def remove(self, key):
+		with self.lock:
+			prefix = key + "/"
+			for entry in list(self.entries.keys()):
+				if entry == key or entry.startswith(prefix):
+					del self.entries[entry]
+					self.verified.discard(entry)
+
+	def remove_id(self, folder_id):
+		with self.lock:
+			keys = [key for key, value in self.entries.items() if value == folder_id]
+		for key in keys:
+			self.remove(key)
+
+	def clear(self):
+		with self.lock:
+			self.entries = {}
+			self.verified = set()
+
+	@staticmethod
+	def load(filepath=None):
+		state = SyncState.open() if filepath is None else None
+		if state is not None:
+			try:
+				entries = state.load_folders()
+			finally:
+				state.close()
+			if len(entries) > 0:
+				return GDriveFolderCache(entries)
+		filepath = filepath or GDriveFolderCache.local_path()
+		if not os.path.exists(filepath):
+			return GDriveFolderCache()
+		try:
+			f = open(filepath, "r")
+			try:
+				data = sublime.decode_value(f.read())
+			finally:
+				f.close()
+		except Exception:
+			return GDriveFolderCache()
+		if not isinstance(data, dict) or data.get("version") != FOLDER_CACHE_VERSION:
+			return GDriveFolderCache()
+		return GDriveFolderCache(data.get("entries"))
+
+	def save(self, filepath=None):
+		state = SyncState.open() if filepath is None else None
+		if state is not None:
+			with self.lock:
+				entries = dict(self.entries)
+			try:
+				state.save_folders(entries)
+			finally:
+				state.close()
+			return
+		filepath = filepath or GDriveFolderCache.local_path()
+		parent = os.path.dirname(filepath)
+		if not os.path.exists(parent):
+			os.makedirs(parent)
+		with self.lock:
+			data = sublime.encode_value({"version": FOLDER_CACHE_VERSION, "entries": self.entries})
+		out = open(filepath, "w")
+		out.write(data)
+		out.close()
+
+
+class GDriveChildIndex():
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.children = {}
+
+	def index(self, parent_id, items):
+		children = {}
+		for item in items:
+			children.setdefault(item["title"], []).append(item)
+		with self.lock:
+			self.children[parent_id] = children
+
+	def find(self, parent_id, title):
+		with self.lock:
+			if parent_id not in self.children:
+				return False, []
+			return True, list(self.children[parent_id].get(title, []))
+
+	def add(self, parent_id, item):
+		with self.lock:
+			if parent_id in self.children:
+				self.children[parent_id].setdefault(item["title"], []).append(item)
+
+	def remove_id(self, item_id):
+		with self.lock:
+			self.children.pop(item_id, None)
+			for children in self.children.values():
+				for title in list(children.keys()):
+					items = [item for item in children[title] if item["id"] != item_id]
+					if len(items) > 0:
+						children[title] = items
+					else:
+						del children[title]
+
+	def clear(self):
+		with self.lock:
+			self.children = {}
+
+
+class GDriveUploadSessions():
+	def __init__(self, entries=None):
+		self.lock = threading.Lock()
+		self.entries = {}
+		if entries:
+			self.entries.update(entries)
+
+	@staticmethod
+	def local_path():
+		return os.path.join(sublime.packages_path(), "User", "DrSync", UPLOAD_SESSIONS_FILENAME)
+
+	def get(self, full_path, fingerprint):
+		with self.lock:
+			entry = self.entries.get(full_path)
+			if entry is None or entry["fingerprint"] != fingerprint:
+				return None
+			return entry["uri"]
+
+	def set(self, full_path, fingerprint, uri):
+		with self.lock:
+			self.entries[full_path] = {"fingerprint": fingerprint, "uri": uri}
+		self.save()
+
+	def remove(self, full_path):
+		with self.lock:
+			if full_path not in self.entries:
+				return
+			del self.entries[full_path]
+		self.save()
+
+	@staticmethod
+	def load(filepath=None):
+		filepath = filepath or GDriveUploadSessions.local_path()
+		if not os.path.exists(filepath):
+			return GDriveUploadSessions()
+		try:
+			f = open(filepath, "r")
+			try:
+				data = sublime.decode_value(f.read())
+			finally:
+				f.close()
+		except Exception:
+			return GDriveUploadSessions()
+		if not isinstance(data, dict):
+			return GDriveUploadSessions()
+		return GDriveUploadSessions(data)
+
+	def save(self, filepath=None):
+		filepath = filepath or GDriveUploadSessions.local_path()
+		parent = os.path.dirname(filepath)
+		if not os.path.exists(parent):
+			os.makedirs(parent)
+		with self.lock:
+			out = open(filepath, "w")
+			out.write(sublime.encode_value(self.entries))
+			out.close()
@@ -1,5 +1,9 @@
 import re
 import os
+import json
+import threading
+from .gdrive_batch import *
+from .gdrive_cache import *
 from .gdrive_connection import *
 from .gdrive_session import *
 from .gdrive_util import *
@@ -7,11 +11,26 @@ from .gdrive_util import *
 OAUTH2_ACCESS_TOKEN_PATTERN = re.compile(r"\A[-_~/A-Za-z0-9\.\+]+=*\Z")
 FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
 BINARY_MIMETYPE = "application/octet-stream"
+ITEM_FIELDS = "id,title,mimeType,fileSize,md5Checksum,parents(id)"
+LIST_PAGE_SIZE = 1000
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v2/files"
+UPLOAD_CHUNK_UNIT = 256 * 1024
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 4 * 1024 * 1024
+RESUMABLE_MAX_RESUMES = 5
 
 class GDriveClient():
 	def __init__(self, credential, token_type, access_token):
 		self.credential = credential
 		self.connection = GDriveConnection()
+		self.folder_cache = GDriveFolderCache.load()
+		self.child_index = GDriveChildIndex()
+		self.upload_sessions = GDriveUploadSessions.load()
+		self.resumable_threshold = RESUMABLE_THRESHOLD
+		self.chunk_size = RESUMABLE_CHUNK_SIZE
+		self.folder_lock = threading.RLock()
+		self.duplicates = []
+		self.duplicate_lock = threading.Lock()
 		if type(access_token) == str:
 			if not OAUTH2_ACCESS_TOKEN_PATTERN.match(access_token):
 				raise ValueError("invalid format for oauth2_access_token: %r" % (access_token))
@@ -34,31 +53,123 @@ class GDriveClient():
 			url = GDriveUtil.build_url(host+target)
 		return url, params, headers
 
+	def configure_retries(self, settings=None, on_retry=None):
+		self.connection.retry_policy = RetryPolicy.from_settings(settings)
+		self.connection.retry_policy.on_retry = on_retry
+		return self.connection.retry_policy
+
+	def configure_uploads(self, settings=None):
+		settings = settings or {}
+		self.resumable_threshold = settings.get("resumable_threshold", RESUMABLE_THRESHOLD)
+		chunk_size = settings.get("chunk_size", RESUMABLE_CHUNK_SIZE)
+		self.chunk_size = max(1, int(chunk_size / UPLOAD_CHUNK_UNIT)) * UPLOAD_CHUNK_UNIT
+
 	def account_info(self, params=None):
 		url, params, headers = self.request(GDriveUtil.build_url("/about", params), method="GET")
 		return self.connection.get(url, headers)["data"]
 
+	def escape_query(self, value):
+		return value.replace("\\", "\\\\").replace("'", "\\'")
+
+	def build_query(self, parent_id=None, title=None, include_file=True, include_folder=True, trashed=False):
+		terms = []
+		if parent_id is not None:
+			terms.append("'%s' in parents" % (self.escape_query(parent_id)))
+		if title is not None:
+			terms.append("title = '%s'" % (self.escape_query(title)))
+		if include_file and not include_folder:
+			terms.append("mimeType != '%s'" % (FOLDER_MIMETYPE))
+		elif include_folder and not include_file:
+			terms.append("mimeType = '%s'" % (FOLDER_MIMETYPE))
+		if trashed is not None:
+			terms.append("trashed = %s" % ("true" if trashed else "false"))
+		return " and ".join(terms)
+
+	def is_match(self, item, file_title, include_file=True, include_folder=True):
+		if item["title"] != file_title:
+			return False
+		if item["mimeType"] == FOLDER_MIMETYPE:
+			return include_folder
+		return include_file
+
 	def is_exists(self, file_title, parent_id="appdata", include_file=True, include_folder=True):
 		try:
-			folderdata = self.metadata({"q": "'"+parent_id+"' in parents"})
-			for item in folderdata["items"]:
-				if ((include_file and item["mimeType"] != FOLDER_MIMETYPE) or (include_folder and item["mimeType"] == FOLDER_MIMETYPE)) and item["title"] == file_title:
+			indexed, items = self.child_index.find(parent_id, file_title)
+			if indexed:
+				for item in items:
+					if self.is_match(item, file_title, include_file, include_folder):
+						return item
+				return None
+			query = self.build_query(parent_id, file_title, include_file, include_folder)
+			for item in self.list_files({"q": query}, max_results=1):
+				if self.is_match(item, file_title, include_file, include_folder):
 					return item
 		except Exception as e:
 			return None
 		return None
 
+	def list_children(self, parent_id="appdata"):
+		items = list(self.list_files({"q": self.build_query(parent_id)}))
+		self.child_index.index(parent_id, items)
+		return items
+
+	def is_folder_valid(self, folder_id):
+		try:
+			url, params, headers = self.request(target="/files/"+folder_id, params={"fields": "id,mimeType,labels/trashed"}, method="GET")
+			folder_data = self.connection.get(url, headers)["data"]
+			return folder_data["mimeType"] == FOLDER_MIMETYPE and not folder_data["labels"]["trashed"]
+		except ErrorResponse as e:
+			if e.status == 404:
+				return False
+			raise e
+
+	def verify_cached_folders(self):
+		folders = self.folder_cache.unverified()
+		if len(folders) == 0:
+			return
+		batch = GDriveBatch(self)
+		for key, folder_id in folders:
+			batch.get_metadata(folder_id, "id,mimeType,labels/trashed")
+		for (key, folder_id), result in zip(folders, batch.execute()):
+			if result.ok() and result.body["mimeType"] == FOLDER_MIMETYPE and not result.body["labels"]["trashed"]:
+				self.folder_cache.set(key, folder_id)
+			elif result.ok() or result.status == 404:
+				self.folder_cache.remove(key)
+
+	def get_cached_folder(self, key):
+		folder_id, verified = self.folder_cache.get(key)
+		if folder_id is not None and not verified:
+			if self.is_folder_valid(folder_id):
+				self.folder_cache.set(key, folder_id)
+			else:
+				self.folder_cache.remove(key)
+				folder_id = None
+		return folder_id
+
 	def create_folder(self, full_path, parent_id="appdata", no_create=False):
-		if len(full_path) > 1:
-			folder_id, pid = self.create_folder(full_path[:1], parent_id, no_create)
-			return self.create_folder(full_path[1:], folder_id, no_create)
-		else:
-			folder_data = self.is_exists(full_path[0], parent_id, include_file=False)
-			if folder_data is None and not no_create:
-				url, params, headers = self.request(target="/files", params={"fields": "id"}, method="GET")
-				params = {"title": full_path[0], "parents": [{"id": parent_id}], "mimeType": FOLDER_MIMETYPE}
-				folder_data = self.connection.post(url, params, headers, as_json=True)["data"]
-			return folder_data["id"], parent_id
+		folder_id = parent_id
+		parent = parent_id
+		for index in range(len(full_path)):
+			parent = folder_id
+			key = GDriveFolderCache.build_key(full_path[:index+1], parent_id)
+			folder_id = self.get_cached_folder(key)
+			if folder_id is not None:
+				continue
+			with self.folder_lock:
+				folder_id = self.get_cached_folder(key)
+				if folder_id is not None:
+					continue
+				folder_data = self.is_exists(full_path[index], parent, include_file=False)
+				if folder_data is None:
+					if no_create:
+						return None, parent
+					url, params, headers = self.request(target="/files", params={"fields": "id"}, method="GET")
+					params = {"title": full_path[index], "parents": [{"id": parent}], "mimeType": FOLDER_MIMETYPE}
+					folder_data = self.connection.post(url, params, headers, as_json=True)["data"]
+					self.child_index.add(parent, {"id": folder_data["id"], "title": full_path[index], "mimeType": FOLDER_MIMETYPE})
+				folder_id = folder_data["id"]
+				self.folder_cache.set(key, folder_id)
+		return folder_id, parent
 
 	def split_path(self, path):
 		if path == os.path.sep:
@@ -68,45 +179,199 @@ class GDriveClient():
 			return [tail]
 		return self.split_path(rest) + [tail]
 
-	def put_file(self, full_path, file_obj):
-		self.delete_all_file(full_path)
+	def find_existing(self, folder_id, title):
+		indexed, items = self.child_index.find(folder_id, title)
+		if not indexed:
+			items = self.list_files({"q": self.build_query(folder_id, title, include_folder=False)})
+		return [item for item in items if self.is_match(item, title, include_folder=False)]
+
+	def queue_duplicates(self, items):
+		with self.duplicate_lock:
+			for item in items:
+				if item["id"] not in self.duplicates:
+					self.duplicates.append(item["id"])
 
+	def remove_duplicates(self):
+		with self.duplicate_lock:
+			file_ids = self.duplicates
+			self.duplicates = []
+		if len(file_ids) > 0:
+			self.delete_files(file_ids)
+		return len(file_ids)
+
+	def put_file(self, full_path, file_obj, file_id=None):
 		folderid = "appdata"
 		if os.path.dirname(full_path) != "":
 			folderid, parentid = self.create_folder(self.split_path(os.path.dirname(full_path)))
 		filename = os.path.basename(full_path)
+		if file_id is None:
+			existing = self.find_existing(folderid, filename)
+			if len(existing) > 0:
+				file_id = existing[0]["id"]
+				self.queue_duplicates(existing[1:])
+		metadata = {"title": filename, "parents": [{"id": folderid}]}
+		base = file_obj.tell()
+		file_data = None
+		if file_id is not None:
+			try:
+				update = dict(metadata, labels={"trashed": False})
+				file_data = self.upload_content(full_path, file_obj, update, file_id)
+			except ErrorResponse as e:
+				if e.status != 404:
+					raise e
+				file_obj.seek(base)
+			self.child_index.remove_id(file_id)
+		if file_data is None:
+			file_data = self.upload_content(full_path, file_obj, metadata)
+		self.child_index.add(folderid, file_data)
+		return file_data
+
+	def upload_content(self, full_path, file_obj, metadata, file_id=None):
+		size = os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+		if self.resumable_threshold is not None and size > 0 and size >= self.resumable_threshold:
+			return self.put_file_resumable(full_path, file_obj, metadata, size, file_id)
 		fields = [
 			{
 				"headers": {
 					"Content-Type": "application/json; charset=UTF-8"
 				},
-				"body": sublime.encode_value({"title": filename, "parents": [{"id": folderid}]}).encode("utf-8")
+				"body": sublime.encode_value(metadata).encode("utf-8")
 			},
 			{
 				"headers": {
 					"Content-Type": BINARY_MIMETYPE
 				},
-				"body": file_obj.read()
+				"body": file_obj
 			}
 		]
-		url, params, headers = self.request(target="https://www.googleapis.com/upload/drive/v2/files", params={"uploadType": "multipart"}, method="GET", no_host=True)
-		return self.connection.post_multipart(url, fields, headers)["data"]
+		target, method = UPLOAD_URL, "POST"
+		if file_id is not None:
+			target, method = UPLOAD_URL + "/" + file_id, "PUT"
+		url, params, headers = self.request(target=target, params={"uploadType": "multipart"}, method="GET", no_host=True)
+		return self.connection.post_multipart(url, fields, headers, method=method)["data"]
+
+	def start_upload_session(self, metadata, size, file_id=None):
+		target, method = UPLOAD_URL, "POST"
+		if file_id is not None:
+			target, method = UPLOAD_URL + "/" + file_id, "PUT"
+		url, params, headers = self.request(target=target, params={"uploadType": "resumable"}, method="GET", no_host=True)
+		headers["X-Upload-Content-Type"] = BINARY_MIMETYPE
+		headers["X-Upload-Content-Length"] = str(size)
+		response = self.connection.request(method, url, metadata, headers=headers, raw_response=True, as_json=True)
+		response["data"].read()
+		return response["headers"]["Location"]
+
+	def get_upload_offset(self, session_uri, size):
+		headers = self.session.build_access_headers()
+		headers["Content-Range"] = "bytes */%d" % (size)
+		response = self.connection.put(session_uri, b"", headers, raw_response=True, accept_status=(201, 308))
+		return self.process_upload_response(response)
+
+	def process_upload_response(self, response):
+		r = response["data"]
+		body = r.read()
+		if r.status == 308:
+			byte_range = response["headers"].get("Range")
+			if byte_range is None:
+				return 0, None
+			return int(byte_range.split("-")[-1]) + 1, None
+		return None, json.loads(body.decode("utf-8"))
+
+	def put_file_resumable(self, full_path, file_obj, metadata, size, file_id=None):
+		base = file_obj.tell()
+		stat = os.fstat(file_obj.fileno())
+		fingerprint = "%d:%d:%s" % (size, stat.st_mtime, file_id or metadata["parents"][0]["id"])
+		session_uri = self.upload_sessions.get(full_path, fingerprint)
+		offset = 0
+		if session_uri is not None:
+			try:
+				offset, file_data = self.get_upload_offset(session_uri, size)
+				if file_data is not None:
+					self.upload_sessions.remove(full_path)
+					return file_data
+			except ErrorResponse as e:
+				session_uri = None
+		if session_uri is None:
+			session_uri = self.start_upload_session(metadata, size, file_id)
+			self.upload_sessions.set(full_path, fingerprint, session_uri)
+			offset = 0
+		resumes = 0
+		while True:
+			file_obj.seek(base + offset)
+			chunk = file_obj.read(self.chunk_size)
+			headers = self.session.build_access_headers()
+			headers["Content-Range"] = "bytes %d-%d/%d" % (offset, offset + len(chunk) - 1, size)
+			try:
+				response = self.connection.put(session_uri, chunk, headers, raw_response=True, accept_status=(201, 308))
+				offset, file_data = self.process_upload_response(response)
+			except Exception as e:
+				if isinstance(e, ErrorResponse) and (e.status < 500 or RetryPolicy.is_exhausted(e)):
+					self.upload_sessions.remove(full_path)
+					raise e
+				resumes += 1
+				if resumes > RESUMABLE_MAX_RESUMES:
+					raise e
+				offset, file_data = self.get_upload_offset(session_uri, size)
+			if file_data is not None:
+				self.upload_sessions.remove(full_path)
+				return file_data
 
 	def delete_all_file(self, full_path):
-		while(True):
-			file_data = self.get_file(full_path)
-			if file_data is None:
-				break
+		self.delete_paths([full_path])
+
+	def find_files(self, full_paths):
+		found = {}
+		lookups = []
+		batch = GDriveBatch(self)
+		for full_path in full_paths:
+			folder_id = "appdata"
+			if os.path.dirname(full_path) != "":
+				folder_id, parent_id = self.create_folder(self.split_path(os.path.dirname(full_path)), no_create=True)
+			if folder_id is None:
+				found[full_path] = []
+				continue
+			title = os.path.basename(full_path)
+			indexed, items = self.child_index.find(folder_id, title)
+			if indexed:
+				found[full_path] = [item for item in items if self.is_match(item, title, include_folder=False)]
 			else:
-				self.delete_file(file_data["id"])
+				lookups.append((full_path, batch.lookup(self.build_query(folder_id, title, include_folder=False), ITEM_FIELDS)))
+		results = batch.execute()
+		for full_path, index in lookups:
+			if not results[index].ok():
+				raise BatchError(full_path, results[index])
+			found[full_path] = results[index].body.get("items", [])
+		return found
+
+	def delete_files(self, file_ids):
+		batch = GDriveBatch(self)
+		for file_id in file_ids:
+			batch.delete(file_id)
+		for file_id, result in zip(file_ids, batch.execute()):
+			if not result.ok() and result.status != 404:
+				raise BatchError(file_id, result)
+			self.folder_cache.remove_id(file_id)
+			self.child_index.remove_id(file_id)
+
+	def delete_paths(self, full_paths):
+		file_ids = []
+		for items in self.find_files(full_paths).values():
+			file_ids += [item["id"] for item in items]
+		if len(file_ids) > 0:
+			self.delete_files(file_ids)
+		return len(file_ids)
 
 	def delete_file(self, file_id):
 		try:
 			url, params, headers = self.request(target="/files/"+file_id, method="GET")
 			self.connection.delete(url, headers, raw_response=True)
+			self.folder_cache.remove_id(file_id)
+			self.child_index.remove_id(file_id)
 			return True
 		except ErrorResponse as e:
 			if e.status == 204:
+				self.folder_cache.remove_id(file_id)
+				self.child_index.remove_id(file_id)
 				return True
 			else:
 				raise e
@@ -126,7 +391,31 @@ class GDriveClient():
 			return None
 		return self.is_exists(filename, folderid, include_folder=False)
 
-	def metadata(self, fields=None, parent_id="appdata"):
-		url, params, headers = self.request(target="/files", params=fields, method="GET")
+	def get_metadata(self, file_id, fields=None):
+		params = {}
+		if fields is not None:
+			params["fields"] = fields
+		url, params, headers = self.request(target="/files/"+file_id, params=params, method="GET")
+		return self.connection.get(url, headers)["data"]
+
+	def list_page(self, params=None):
+		url, params, headers = self.request(target="/files", params=params, method="GET")
 		return self.connection.get(url, headers)["data"]
 
+	def list_files(self, params=None, fields=ITEM_FIELDS, max_results=LIST_PAGE_SIZE):
+		params = dict(params or {})
+		if fields is not None and "fields" not in params:
+			params["fields"] = "nextPageToken,items(%s)" % (fields)
+		if max_results is not None and "maxResults" not in params:
+			params["maxResults"] = max_results
+		while True:
+			page = self.list_page(dict(params))
+			for item in page.get("items", []):
+				yield item
+			if not page.get("nextPageToken"):
+				break
+			params["pageToken"] = page["nextPageToken"]
+
+	def metadata(self, fields=None, parent_id="appdata"):
+		return {"items": list(self.list_files(fields))}
+
@@ -1,31 +1,29 @@
 import sublime
 import json
+import os
 import socket
+import uuid
 from ..urllib3 import *
+from ..drsync_pool import *
+from ..drsync_retry import *
+from ..drsync_throttle import *
 from .gdrive_util import *
 
+GDRIVE_POOL = SharedPoolManager(num_pools=4, maxsize=8, timeout=60.0)
+
+
 class GDriveConnection():
+	def __init__(self, retry_policy=None):
+		self.retry_policy = retry_policy or RetryPolicy()
 
-	def request(self, method, url, params=None, body=None, headers=None, raw_response=False, as_json=False):
-		try:
-			import ssl
-			pool_manager = PoolManager(
-				num_pools=4,
-				maxsize=8,
-				block=False,
-				timeout=60.0,
-				cert_reqs=ssl.CERT_REQUIRED,
-				ca_certs=GDriveUtil.get_cert_file(),
-				ssl_version=ssl.PROTOCOL_TLSv1,
-			)
-		except (ImportError):
-			pool_manager = PoolManager(
-				num_pools=4,
-				maxsize=8,
-				block=False,
-				timeout=60.0,
-			)
+	@staticmethod
+	def get_pool():
+		ssl_context = GDriveUtil.get_ssl_context()
+		if GDRIVE_POOL.connection_pool_kw.get("ssl_context", False) is not ssl_context:
+			GDRIVE_POOL.configure(ssl_context=ssl_context)
+		return GDRIVE_POOL
 
+	def request(self, method, url, params=None, body=None, headers=None, raw_response=False, as_json=False, accept_status=None):
 		params = params or {}
 		headers = headers or {}
 		headers["User-Agent"] = "DrSync/0.1"
@@ -44,23 +42,36 @@ class GDriveConnection():
 		if hasattr(body, "getvalue"):
 			body = str(body.getvalue())
 			headers["Content-Length"] = len(body)
-		if hasattr(body, "read"):
+		offset = body.tell() if hasattr(body, "seek") else None
+		if hasattr(body, "fileno"):
+			headers["Content-Length"] = os.fstat(body.fileno()).st_size - offset
+		elif hasattr(body, "read"):
 			headers["Content-Length"] = len(body.read())
+			if offset is not None:
+				body.seek(offset)
 
 		for key, value in headers.items():
 			if type(value) == str and "\n" in value:
 				raise ValueError("headers should not contain newlines (" + key + ": " + value + ")")
 
-		try:
-			response = pool_manager.urlopen(method=method, url=url, body=body, headers=headers, preload_content=False)
-		except socket.error as e:
-			raise SocketError(url, e)
-		except exceptions.SSLError as e:
-			raise SocketError(url, "SSL certificate error: %s" % e)
-
-		if response.status != 200:
-			raise ErrorResponse(response, response.read())
-		return {"headers": response.headers, "data": self.process_response(response, raw_response)}
+		attempt = 0
+		while True:
+			if offset is not None:
+				body.seek(offset)
+			try:
+				response = self.get_pool().urlopen(method=method, url=url, body=UPLOAD_BUCKET.wrap_body(body, headers), headers=headers, preload_content=False)
+			except socket.error as e:
+				raise SocketError(url, e)
+			except exceptions.SSLError as e:
+				raise SocketError(url, "SSL certificate error: %s" % e)
+
+			if response.status == 200 or (accept_status is not None and response.status in accept_status):
+				break
+			error = ErrorResponse(response, response.read())
+			if not self.retry_policy.wait(error, attempt):
+				raise error
+			attempt += 1
+		return {"headers": response.headers, "data": self.process_response(DOWNLOAD_BUCKET.wrap_response(response), raw_response)}
 
 	def process_response(self, r, raw_response):
 		if raw_response:
@@ -80,22 +91,56 @@ class GDriveConnection():
 	def post(self, url, params=None, headers=None, raw_response=False, as_json=False):
 		return self.request("POST", url, params=params, headers=headers, raw_response=raw_response, as_json=as_json)
 
-	def post_multipart(self, url, fields={}, headers=None, raw_response=False):
-		boundary = "drsync_data"
-		body = b""
-		headers["Content-Type"] = "multipart/related; boundary=\""+boundary+"\""
-		for part in fields:
-			body += ("\n\n--" + boundary).encode("utf-8")
-			if "headers" in part:
-				for hk in part["headers"]:
-					body += ("\n%s: %s" % (hk, part["headers"][hk])).encode("utf-8")
-			body += b"\n\n" + part["body"]
-		body += ("\n\n--" + boundary + "--").encode("utf-8")
+	def post_multipart(self, url, fields={}, headers=None, raw_response=False, method="POST"):
+		body = MultipartBody("drsync_data_" + uuid.uuid4().hex, fields)
+		headers["Content-Type"] = "multipart/related; boundary=\""+body.boundary+"\""
 		headers["Content-Length"] = len(body)
-		return self.request("POST", url, body=body, headers=headers, raw_response=raw_response)
-
-	def put(self, url, body, headers=None, raw_response=False):
-		return self.request("PUT", url, body=body, headers=headers, raw_response=raw_response)
+		return self.request(method, url, body=body, headers=headers, raw_response=raw_response)
+
+	def put(self, url, body, headers=None, raw_response=False, accept_status=None):
+		return self.request("PUT", url, body=body, headers=headers, raw_response=raw_response, accept_status=accept_status)
+
+
+class MultipartBody():
+	def __init__(self, boundary, fields, block_size=65536):
+		self.boundary = boundary
+		self.fields = fields
+		self.block_size = block_size
+		self.offsets = [part["body"].tell() if hasattr(part["body"], "read") else 0 for part in fields]
+
+	def part_header(self, part):
+		header = "\n\n--" + self.boundary
+		if "headers" in part:
+			for hk in part["headers"]:
+				header += "\n%s: %s" % (hk, part["headers"][hk])
+		return (header + "\n\n").encode("utf-8")
+
+	def footer(self):
+		return ("\n\n--" + self.boundary + "--").encode("utf-8")
+
+	def __len__(self):
+		length = len(self.footer())
+		for index, part in enumerate(self.fields):
+			length += len(self.part_header(part))
+			if hasattr(part["body"], "read"):
+				length += os.fstat(part["body"].fileno()).st_size - self.offsets[index]
+			else:
+				length += len(part["body"])
+		return length
+
+	def __iter__(self):
+		for index, part in enumerate(self.fields):
+			yield self.part_header(part)
+			if hasattr(part["body"], "read"):
+				part["body"].seek(self.offsets[index])
+				while True:
+					block = part["body"].read(self.block_size)
+					if not block:
+						break
+					yield block
+			else:
+				yield part["body"]
+		yield self.footer()
 
 
 class SocketError(socket.error):
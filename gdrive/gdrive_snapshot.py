@@ -0,0 +1,89 @@
+import os
+from .gdrive_cache import *
+from .gdrive_client import *
+
+
+SNAPSHOT_FIELDS = "nextPageToken,items(id,title,mimeType,fileSize,md5Checksum,parents(id))"
+SNAPSHOT_PAGE_SIZE = 1000
+
+
+class GDriveSnapshot():
+	def __init__(self, root_id, items):
+		self.root_id = root_id
+		self.items = {}
+		self.paths = {}
+		self.by_path = {}
+		for item in items:
+			self.items[item["id"]] = item
+		for item_id in self.items:
+			path = self.path_of(item_id)
+			if path is not None and path not in self.by_path:
+				self.by_path[path] = self.items[item_id]
+
+	@staticmethod
+	def fetch(client):
+		root_id = client.get_metadata("appdata", "id")["id"]
+		items = client.list_files({
+			"q": "trashed = false",
+			"spaces": "appDataFolder",
+			"fields": SNAPSHOT_FIELDS,
+			"maxResults": SNAPSHOT_PAGE_SIZE
+		})
+		return GDriveSnapshot(root_id, items)
+
+	def path_of(self, item_id):
+		if item_id in self.paths:
+			return self.paths[item_id]
+		chain = []
+		current = item_id
+		path = None
+		while current is not None:
+			if current == self.root_id:
+				path = ()
+				break
+			if current in self.paths:
+				path = self.paths[current]
+				break
+			if current not in self.items or current in chain:
+				break
+			chain.append(current)
+			parents = self.items[current].get("parents") or []
+			current = parents[0]["id"] if len(parents) > 0 else None
+		for current in reversed(chain):
+			if path is not None:
+				path = path + (self.items[current]["title"],)
+			self.paths[current] = path
+		return self.paths.get(item_id)
+
+	def is_folder(self, item):
+		return item["mimeType"] == FOLDER_MIMETYPE
+
+	def find(self, full_path):
+		return self.by_path.get(tuple(full_path))
+
+	def files_under(self, full_path):
+		full_path = tuple(full_path)
+		file_list = []
+		for path, item in self.by_path.items():
+			if path[:len(full_path)] == full_path and len(path) > len(full_path) and not self.is_folder(item):
+				file_list.append([os.path.join(*path), item["id"], int(item.get("fileSize", 0)), item.get("md5Checksum")])
+		file_list.sort()
+		return file_list
+
+	def populate(self, client):
+		children = {"appdata": []}
+		for path, item in self.by_path.items():
+			if self.is_folder(item):
+				client.folder_cache.set(GDriveFolderCache.build_key(path), item["id"])
+				children.setdefault(item["id"], [])
+			parent_id = "appdata" if len(path) == 1 else item["parents"][0]["id"]
+			children.setdefault(parent_id, []).append(item)
+		for parent_id, items in children.items():
+			client.child_index.index(parent_id, items)
+
+	def to_entries(self):
+		entries = {}
+		for path, item in self.by_path.items():
+			if not self.is_folder(item) and "md5Checksum" in item:
+				entries["/".join(path)] = {"size": int(item.get("fileSize", 0)), "mtime": 0, "hash": item["md5Checksum"]}
+		return entries
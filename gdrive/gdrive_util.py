@@ -2,6 +2,7 @@ import re
 import os
 import sublime
 import urllib
+from ..drsync_pool import SSLContextCache
 
 class GDriveUtil():
 	AUTHORIZE_URL = "https://accounts.google.com/o/oauth2/auth"
@@ -10,7 +11,11 @@ class GDriveUtil():
 	OOB_CALLBACK_URN = "urn:ietf:wg:oauth:2.0:oob"
 
 	@staticmethod
-	def get_cert_file():
+	def invalidate_cert_file():
+		GDriveUtil.CERT_CACHE.invalidate()
+
+	@staticmethod
+	def resolve_cert_file():
 		certs = sublime.find_resources("*.crt")
 		for cert in certs:
 			certparent = os.path.dirname(cert)
@@ -20,15 +25,30 @@ class GDriveUtil():
 		parent = os.path.join(sublime.packages_path(), "User", "DrSync")
 		certs = sublime.find_resources("gdrive.certification")
 		for cert in certs:
+			content = sublime.load_resource(cert)
+			certfile = os.path.join(parent, "gdrive.crt")
+			if os.path.exists(certfile):
+				r = open(certfile, "r")
+				existing = r.read()
+				r.close()
+				if existing == content:
+					return certfile
 			if not os.path.exists(parent):
 				os.makedirs(parent)
-			certfile = os.path.join(parent, "gdrive.crt")
 			w = open(certfile, "w")
-			w.write(sublime.load_resource(cert))
+			w.write(content)
 			w.close()
 			return certfile
 		return ""
 
+	@staticmethod
+	def get_cert_file():
+		return GDriveUtil.CERT_CACHE.get_cert_file()
+
+	@staticmethod
+	def get_ssl_context():
+		return GDriveUtil.CERT_CACHE.get_ssl_context()
+
 	@staticmethod
 	def build_url(target, params=None):
 		params = params or {}
@@ -49,3 +69,5 @@ class GDriveUtil():
 			return (u"" if isinstance(path, str) else "")
 		else:
 			return '/' + path.strip('/')
+
+GDriveUtil.CERT_CACHE = SSLContextCache(GDriveUtil.resolve_cert_file)
@@ -1,9 +1,19 @@
+import hashlib
 import threading
-from tempfile import gettempdir
+from tempfile import gettempdir, TemporaryFile
 from .gdrive import *
+from .drsync_atomic import *
+from .drsync_bundle import *
+from .drsync_chunk_store import *
+from .drsync_filter import *
+from .drsync_manifest import *
+from .drsync_transfer import *
 
 
 GDRIVE_SYNC_SCHEMA = "DrSync.drsync-data"
+GDRIVE_SYNC_BUNDLE = BUNDLE_FILENAME
+GDRIVE_SYNC_MANIFEST = MANIFEST_FILENAME
+DOWNLOAD_BLOCK_SIZE = 65536
 
 
 class GDrivePreAuthenticationThread(threading.Thread):
@@ -68,49 +78,194 @@ class GDriveAuthenticationThread(threading.Thread):
 
 
 class GDriveSyncUpThread(threading.Thread):
-	def __init__(self, data, file_list, client):
+	def __init__(self, data, file_list, client, previous_data=None, transfer_settings=None):
 		self.data = data
 		self.file_list = file_list
 		self.client = client
+		self.previous_data = previous_data
+		self.transfer_settings = transfer_settings
 		self.percentage = 0
 		threading.Thread.__init__(self)
 
+	def on_progress(self, engine, name):
+		self.percentage = engine.percentage()
+		self.progress = engine.describe()
+		if name is not None:
+			self.filename = name
+
+	def on_retry(self, policy, delay, error):
+		self.progress = "Retrying in %.1fs, %s" % (delay, policy.describe())
+
+	def upload_name(self, item):
+		return os.path.basename(item[1])
+
+	def upload_size(self, item):
+		if len(item) > 3:
+			return item[2]
+		return os.path.getsize(item[1])
+
+	def create_folder(self, path):
+		self.client.create_folder(self.client.split_path(path))
+
+	def upload_file(self, item):
+		parent, filepath = item[:2]
+		path = os.path.join(os.path.basename(parent), os.path.relpath(filepath, parent))
+		relative_path = SyncManifest.relative_path(parent, filepath)
+		f = open(filepath, "rb")
+		try:
+			file_data = self.client.put_file(path, f, self.remote_manifest.entries.get(relative_path, {}).get("id"))
+		finally:
+			f.close()
+		self.local_manifest.entries[relative_path]["id"] = file_data["id"]
+
+	def upload_chunked_file(self, item):
+		parent, filepath = item[:2]
+		chunk_ids = self.chunk_store.store_file(filepath)
+		self.local_manifest.entries[SyncManifest.relative_path(parent, filepath)]["chunks"] = chunk_ids
+
+	def batches(self, paths):
+		return [paths[index:index+BATCH_LIMIT] for index in range(0, len(paths), BATCH_LIMIT)]
+
+	def batch_name(self, paths):
+		return "Removing %d files" % (len(paths))
+
+	def chunk_garbage(self, remote_manifest, local_manifest):
+		try:
+			snapshot = GDriveSnapshot.fetch(self.client)
+		except Exception as e:
+			return ChunkStore.garbage(remote_manifest, local_manifest)
+		snapshot.populate(self.client)
+		return ChunkStore.sweep([record[0] for record in snapshot.files_under([CHUNK_FOLDER])], local_manifest)
+
+	def bundle_name(self, record):
+		self.filename = os.path.basename(record[1])
+		return SyncManifest.relative_path(record[0], record[1])
+
+	def put_bundle(self, bundle):
+		bundle.seek(0)
+		self.client.put_file(GDRIVE_SYNC_BUNDLE, bundle)
+
+	def upload_bundle(self, engine):
+		bundle = SyncBundle.build(self.file_list, self.bundle_name)
+		try:
+			engine.run([bundle], self.put_bundle, lambda item: GDRIVE_SYNC_BUNDLE)
+		finally:
+			bundle.close()
+
+	def get_remote_manifest(self):
+		file_data = self.client.get_file(GDRIVE_SYNC_MANIFEST)
+		if file_data is None:
+			if self.transfer_settings is not None and self.transfer_settings.get("fast_gather", True):
+				snapshot = GDriveSnapshot.fetch(self.client)
+				snapshot.populate(self.client)
+				return SyncManifest(snapshot.to_entries())
+			return SyncManifest()
+		fp = self.client.get_file_content(file_data["id"])
+		return SyncManifest.decode(fp.read().decode("utf-8"))
+
+	def put_data(self, full_path, data):
+		tmppath = os.path.join(gettempdir(), "DrSync.drsync-tmp")
+		out = open(tmppath, "wb")
+		out.write(data.encode("utf-8"))
+		out.close()
+		f = open(tmppath, "rb")
+		self.client.put_file(full_path, f)
+		f.close()
+
 	def run(self):
 		currentfile = ""
 		try:
 			self.filename = "Preparing"
-			self.client.delete_all_file(GDRIVE_SYNC_SCHEMA)
-			index = 0
-			for parent, filepath in self.file_list:
-				self.percentage = int(index*100/(len(self.file_list)+1))
-				currentfile = os.path.basename(filepath)
-				self.filename = currentfile
-				path = os.path.join(os.path.basename(parent), os.path.relpath(filepath, parent))
-				f = open(filepath, "rb")
-				self.client.put_file(path, f)
-				index += 1
-			self.percentage = int(index*100/(len(self.file_list)+1))
-			tmppath = os.path.join(gettempdir(), "DrSync.drsync-tmp")
-			out = open(tmppath, "wb")
-			out.write(sublime.encode_value(self.data).encode("utf-8"))
-			out.close()
-			f = open(tmppath, "rb")
-			self.client.put_file(GDRIVE_SYNC_SCHEMA, f)
+			self.retry_policy = self.client.configure_retries(self.transfer_settings, self.on_retry)
+			self.client.configure_uploads(self.transfer_settings)
+			remote_manifest = self.get_remote_manifest()
+			local_manifest = SyncManifest.from_files(self.file_list, SyncManifest.load_local())
+			layout = self.data.get("layout", "files")
+			if layout == "bundle":
+				local_manifest.mark_bundled()
+			changed, removed = local_manifest.diff(remote_manifest, layout)
+			changed_paths = set(changed)
+			upload_list = [record for record in self.file_list if SyncManifest.relative_path(record[0], record[1]) in changed_paths]
+			if len(upload_list) == 0 and len(removed) == 0 and self.previous_data is not None and self.previous_data["settings"] == self.data["settings"]:
+				local_manifest.save_local()
+				self.percentage = 100
+				self.result = True
+				return
+			self.client.verify_cached_folders()
+			remote_layouts = dict([(path, SyncManifest.layout_of(entry)) for path, entry in remote_manifest.entries.items()])
+			removed_files = [path for path in removed + changed if remote_layouts.get(path) == "files" and (layout != "files" or path not in local_manifest.entries)]
+			removed_batches = self.batches(removed_files)
+			engine = TransferEngine.from_settings(self.transfer_settings, self.on_progress, self.retry_policy)
+			engine.add_total((1 if layout == "bundle" else len(upload_list)) + len(removed_batches) + 1)
+			self.local_manifest = local_manifest
+			self.remote_manifest = remote_manifest
+			if layout == "bundle":
+				self.filename = "Bundling"
+				self.upload_bundle(engine)
+			elif layout == "chunks":
+				self.chunk_store = ChunkStore(put_object=self.client.put_file, known=ChunkStore.referenced(remote_manifest))
+				engine.run(upload_list, self.upload_chunked_file, self.upload_name, weight_fx=self.upload_size)
+			else:
+				self.filename = "Creating folders"
+				engine.run_folders([SyncManifest.relative_path(record[0], record[1]) for record in upload_list], self.create_folder)
+				engine.run(upload_list, self.upload_file, self.upload_name, weight_fx=self.upload_size)
+			engine.run(removed_batches, self.client.delete_paths, self.batch_name)
+			if layout == "chunks" or "chunks" in remote_layouts.values():
+				self.filename = "Sweeping chunks"
+				chunk_batches = self.batches([ChunkStore.chunk_path(chunk_id) for chunk_id in self.chunk_garbage(remote_manifest, local_manifest)])
+				engine.add_total(len(chunk_batches))
+				engine.run(chunk_batches, self.client.delete_paths, self.batch_name)
+			if layout != "bundle" and "bundle" in remote_layouts.values():
+				self.client.delete_all_file(GDRIVE_SYNC_BUNDLE)
+			self.put_data(GDRIVE_SYNC_MANIFEST, local_manifest.encode())
+			self.put_data(GDRIVE_SYNC_SCHEMA, sublime.encode_value(self.data))
+			engine.report(os.path.basename(GDRIVE_SYNC_SCHEMA))
+			self.client.remove_duplicates()
+			local_manifest.save_local()
+			self.client.folder_cache.save()
 
 			self.result = True
 		except Exception as e:
+			if isinstance(e, TransferError):
+				currentfile = e.name
 			self.result_message = "GDrive Error [U] on %s: %s" % (currentfile, e)
 			self.result = False
 			self.exception = e
 
 
 class GDriveSyncGatherThread(threading.Thread):
-	def __init__(self, paths, data, client):
+	def __init__(self, paths, data, client, transfer_settings=None, filter_engine=None):
 		self.paths = paths
 		self.data = data
 		self.client = client
+		self.transfer_settings = transfer_settings or {}
+		self.filter_engine = filter_engine or FilterEngine()
+		self.snapshot = None
 		threading.Thread.__init__(self)
 
+	def get_snapshot(self):
+		if not self.transfer_settings.get("fast_gather", True):
+			return None
+		try:
+			snapshot = GDriveSnapshot.fetch(self.client)
+			snapshot.populate(self.client)
+			return snapshot
+		except Exception as e:
+			return None
+
+	def gather_folder(self, full_path):
+		if self.snapshot is not None:
+			return self.snapshot.files_under(full_path)
+		return self.get_all(full_path)
+
+	def gather_file(self, filepath):
+		if self.snapshot is not None:
+			file_data = self.snapshot.find(self.client.split_path(filepath))
+			if file_data is None or self.snapshot.is_folder(file_data):
+				return None
+			return file_data
+		return self.client.get_file(filepath)
+
 	def get_all(self, full_path, parent_id="appdata", current_path=[]):
 		file_list = []
 		try:
@@ -119,52 +274,87 @@ class GDriveSyncGatherThread(threading.Thread):
 				return file_list if folder_data is None else self.get_all(full_path[1:], folder_data["id"], current_path+[full_path[0]])
 			else:
 				file_data = self.client.is_exists(full_path[0], parent_id)
-				folder_data = self.client.metadata({"q": "'"+file_data["id"]+"' in parents"})
-				if folder_data is not None:
-					if "items" in folder_data:
-						for item in folder_data["items"]:
-							if item["mimeType"] == FOLDER_MIMETYPE:
-								file_list += self.get_all([item["title"]], file_data["id"], current_path+[full_path[0]])
-							else:
-								file_path = []
-								file_path += current_path
-								file_path.append(full_path[0])
-								file_path.append(item["title"])
-								file_list.append([os.path.join(*file_path), item["id"]])
+				if file_data["mimeType"] == FOLDER_MIMETYPE:
+					self.client.folder_cache.set(GDriveFolderCache.build_key(current_path+[full_path[0]]), file_data["id"])
+				for item in self.client.list_children(file_data["id"]):
+					if item["mimeType"] == FOLDER_MIMETYPE:
+						if self.filter_engine.match("/".join(current_path+[full_path[0], item["title"]]), True):
+							continue
+						file_list += self.get_all([item["title"]], file_data["id"], current_path+[full_path[0]])
+					else:
+						file_path = []
+						file_path += current_path
+						file_path.append(full_path[0])
+						file_path.append(item["title"])
+						file_list.append([os.path.join(*file_path), item["id"], int(item.get("fileSize", 0)), item.get("md5Checksum")])
 				return file_list
 		except Exception as e:
 			pass
 		return file_list
 
+	def get_user_files(self, settings):
+		files = []
+		if settings["package_control_preferences"]:
+			files += ["Package Control.sublime-settings"]
+		if settings["drsync_preferences"]:
+			files += ["DrSync.sublime-settings"]
+		if settings["sublime_preferences"]:
+			files += ["Preferences.sublime-settings", "Default (Windows).sublime-keymap", "Default (OSX).sublime-keymap", "Default (Linux).sublime-keymap"]
+		return files
+
+	def get_manifest(self):
+		file_data = self.client.get_file(GDRIVE_SYNC_MANIFEST)
+		if file_data is None:
+			return SyncManifest()
+		fp = self.client.get_file_content(file_data["id"])
+		return SyncManifest.decode(fp.read().decode("utf-8"))
+
+	def gather_manifest(self, layout):
+		settings = self.data["settings"]
+		roots = {}
+		if settings["installed_packages"]:
+			roots[os.path.basename(self.paths["installed_packages"])] = (self.paths["installed_packages"], None)
+		if settings["local_packages"]:
+			roots[os.path.basename(self.paths["packages"])] = (self.paths["packages"], None)
+		if settings["user_directory"]:
+			roots[os.path.basename(self.paths["packages_user"])] = (self.paths["packages_user"], None)
+		else:
+			roots[os.path.basename(self.paths["packages_user"])] = (self.paths["packages_user"], self.get_user_files(settings))
+		file_list = []
+		for target, path, entry in self.get_manifest().select(roots, layout):
+			file_list.append([target, path.replace("/", os.path.sep), entry["size"], entry.get("chunks"), {"size": entry["size"], "hash": entry["hash"]}])
+		return file_list
+
 	def run(self):
 		try:
+			self.client.configure_retries(self.transfer_settings)
 			self.file_list = []
-			settings = self.data["settings"]
-			if settings["installed_packages"]:
-				files = self.get_all(self.client.split_path(os.path.basename(self.paths["installed_packages"])))
-				for current_path, item_id in files:
-					self.file_list.append([self.paths["installed_packages"], current_path, item_id])
-			if settings["local_packages"]:
-				files = self.get_all(self.client.split_path(os.path.basename(self.paths["packages"])))
-				for current_path, item_id in files:
-					self.file_list.append([self.paths["packages"], current_path, item_id])
-			if settings["user_directory"]:
-				files = self.get_all(self.client.split_path(os.path.basename(self.paths["packages_user"])))
-				for current_path, item_id in files:
-					self.file_list.append([self.paths["packages_user"], current_path, item_id])
+			if self.data.get("layout", "files") != "files":
+				self.file_list = self.gather_manifest(self.data["layout"])
 			else:
-				files = []
-				if settings["package_control_preferences"]:
-					files += ["Package Control.sublime-settings"]
-				if settings["drsync_preferences"]:
-					files += ["DrSync.sublime-settings"]
-				if settings["sublime_preferences"]:
-					files += ["Preferences.sublime-settings", "Default (Windows).sublime-keymap", "Default (OSX).sublime-keymap", "Default (Linux).sublime-keymap"]
-				for filename in files:
-					filepath = os.path.join(os.path.basename(self.paths["packages_user"]), filename)
-					file_data = self.client.get_file(filepath)
-					if file_data is not None:
-						self.file_list.append([self.paths["packages_user"], filepath, file_data["id"]])
+				self.snapshot = self.get_snapshot()
+				settings = self.data["settings"]
+				if settings["installed_packages"]:
+					files = self.gather_folder(self.client.split_path(os.path.basename(self.paths["installed_packages"])))
+					for current_path, item_id, size, checksum in files:
+						self.file_list.append([self.paths["installed_packages"], current_path, size, None, {"size": size, "hash": checksum, "id": item_id}])
+				if settings["local_packages"]:
+					files = self.gather_folder(self.client.split_path(os.path.basename(self.paths["packages"])))
+					for current_path, item_id, size, checksum in files:
+						self.file_list.append([self.paths["packages"], current_path, size, None, {"size": size, "hash": checksum, "id": item_id}])
+				if settings["user_directory"]:
+					files = self.gather_folder(self.client.split_path(os.path.basename(self.paths["packages_user"])))
+					for current_path, item_id, size, checksum in files:
+						self.file_list.append([self.paths["packages_user"], current_path, size, None, {"size": size, "hash": checksum, "id": item_id}])
+				else:
+					for filename in self.get_user_files(settings):
+						filepath = os.path.join(os.path.basename(self.paths["packages_user"]), filename)
+						file_data = self.gather_file(filepath)
+						if file_data is not None:
+							size = int(file_data.get("fileSize", 0))
+							self.file_list.append([self.paths["packages_user"], filepath, size, None, {"size": size, "hash": file_data.get("md5Checksum"), "id": file_data["id"]}])
+			self.file_list = [item for item in self.file_list if not self.filter_engine.is_excluded(item[1])]
+			self.client.folder_cache.save()
 			self.result = True
 		except Exception as e:
 			self.result_message = "GDrive Error [G] gathering: %s" % (e)
@@ -173,33 +363,157 @@ class GDriveSyncGatherThread(threading.Thread):
 
 
 class GDriveSyncDownThread(threading.Thread):
-	def __init__(self, data, file_list, client):
+	def __init__(self, data, file_list, client, transfer_settings=None):
 		self.data = data
 		self.file_list = file_list
 		self.client = client
+		self.transfer_settings = transfer_settings
+		self.fsync = (transfer_settings or {}).get("fsync", False)
 		self.percentage = 0
 		threading.Thread.__init__(self)
 
+	def on_progress(self, engine, name):
+		self.percentage = engine.percentage()
+		self.progress = engine.describe()
+		if name is not None:
+			self.filename = name
+
+	def on_retry(self, policy, delay, error):
+		self.progress = "Retrying in %.1fs, %s" % (delay, policy.describe())
+
+	def target_path(self, target, filepath):
+		targetname = os.path.basename(target)
+		return os.path.join(target, filepath[len(targetname)+1:])
+
+	def download_name(self, item):
+		return os.path.basename(item[1])
+
+	def download_size(self, item):
+		return item[2]
+
+	def manifest_path(self, item):
+		return SyncManifest.relative_path(item[0], self.target_path(item[0], item[1]))
+
+	def is_unchanged(self, item):
+		return self.local_manifest.matches(self.manifest_path(item), self.target_path(item[0], item[1]), item[4])
+
+	def download_file(self, item):
+		target, filepath, size, chunk_ids, remote = item
+		name = os.path.basename(filepath)
+		md5 = hashlib.md5()
+		written = 0
+		try:
+			f = self.client.get_file_content(remote["id"])
+			out = AtomicFile(self.target_path(target, filepath), self.fsync)
+			try:
+				for block in f.stream(DOWNLOAD_BLOCK_SIZE):
+					out.write(block)
+					md5.update(block)
+					written += len(block)
+					self.engine.add_transferred(len(block), name)
+				out.commit()
+			finally:
+				out.close()
+				f.release_conn()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+		self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote, md5.hexdigest())
+
+	def get_chunk(self, path):
+		file_data = self.client.get_file(path)
+		if file_data is None:
+			raise ValueError("chunk %s is missing" % (os.path.basename(path)))
+		return self.client.get_file_content(file_data["id"])
+
+	def download_chunked_file(self, item):
+		target, filepath, size, chunk_ids, remote = item
+		name = os.path.basename(filepath)
+		written = 0
+		def on_data(length):
+			nonlocal written
+			written += length
+			self.engine.add_transferred(length, name)
+		try:
+			out = AtomicFile(self.target_path(target, filepath), self.fsync)
+			try:
+				self.chunk_store.restore_file(chunk_ids, out, on_data)
+				out.commit()
+			finally:
+				out.close()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+		self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote)
+
+	def fetch_bundle(self, bundle):
+		bundle.seek(0)
+		bundle.truncate()
+		written = 0
+		try:
+			f = self.client.get_file_content(self.bundle_id)
+			try:
+				for block in f.stream(DOWNLOAD_BLOCK_SIZE):
+					bundle.write(block)
+					written += len(block)
+					self.engine.add_transferred(len(block), GDRIVE_SYNC_BUNDLE)
+			finally:
+				f.release_conn()
+		except Exception as e:
+			self.engine.add_transferred(-written)
+			raise e
+
+	def download_bundle(self):
+		file_data = self.client.get_file(GDRIVE_SYNC_BUNDLE)
+		if file_data is None:
+			raise ValueError("%s is missing" % (GDRIVE_SYNC_BUNDLE))
+		self.bundle_id = file_data["id"]
+		self.engine.add_total(0, int(file_data.get("fileSize", 0)))
+		tmp = TemporaryFile()
+		try:
+			self.engine.run([tmp], self.fetch_bundle, lambda item: GDRIVE_SYNC_BUNDLE, counted=False)
+			tmp.seek(0)
+			bundle = SyncBundle(tmp)
+		except Exception as e:
+			tmp.close()
+			raise e
+		try:
+			for item in self.download_list:
+				target, filepath, size, chunk_ids, remote = item
+				self.filename = os.path.basename(filepath)
+				bundle.extract(filepath.replace(os.path.sep, "/"), self.target_path(target, filepath), self.fsync)
+				self.local_manifest.record(self.manifest_path(item), self.target_path(target, filepath), remote)
+				self.engine.report(self.filename, size)
+		finally:
+			bundle.close()
+
 	def run(self):
 		currentfile = ""
 		try:
-			index = 0
-			for target, filepath, file_id in self.file_list:
-				currentfile = os.path.basename(filepath)
-				self.filename = currentfile
-				self.percentage = int(index*100/len(self.file_list))
-				targetname = os.path.basename(target)
-				targetpath = os.path.join(target, filepath[len(targetname)+1:])
-				targetdir = os.path.dirname(targetpath)
-				f = self.client.get_file_content(file_id)
+			self.filename = "Comparing"
+			self.retry_policy = self.client.configure_retries(self.transfer_settings, self.on_retry)
+			self.local_manifest = SyncManifest.load_local()
+			self.download_list = [item for item in self.file_list if not self.is_unchanged(item)]
+			self.chunk_store = ChunkStore(get_object=self.get_chunk)
+			self.engine = TransferEngine.from_settings(self.transfer_settings, self.on_progress, self.retry_policy)
+			self.engine.add_total(len(self.download_list), sum([item[2] for item in self.download_list]))
+			targetdirs = set([os.path.dirname(self.target_path(item[0], item[1])) for item in self.download_list])
+			for targetdir in sorted(targetdirs):
 				if not os.path.exists(targetdir):
 					os.makedirs(targetdir)
-				out = open(targetpath, "wb")
-				out.write(f.read())
-				out.close()
-				index += 1
+			if len(self.download_list) == 0:
+				self.percentage = 100
+			elif self.data.get("layout") == "bundle":
+				self.download_bundle()
+			elif self.data.get("layout") == "chunks":
+				self.engine.run(self.download_list, self.download_chunked_file, self.download_name, weight_fx=self.download_size)
+			else:
+				self.engine.run(self.download_list, self.download_file, self.download_name, weight_fx=self.download_size)
+			self.local_manifest.save_local()
 			self.result = True
 		except Exception as e:
+			if isinstance(e, TransferError):
+				currentfile = e.name
 			self.result_message = "GDrive Error [D] on %s: %s" % (currentfile, e)
 			self.result = False
 			self.exception = e